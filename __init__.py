@@ -1,6 +1,7 @@
 DOWNLOAD_DIR = 'downloaded_files'
 EXTRACT_DIR = 'extracted_files'
 CSV_DIR = 'generated_csv'
+CACHE_DIR = 'cached_files'
 
 GEO_TYPES_DICT = {
     'cd': 'Congressional Districts',
@@ -25,6 +26,10 @@ GEO_TYPES_LIST = sorted([
 # >> python fetch_shapefiles.py -g zcta5
 DISABLE_AUTO_DOWNLOADS = ['zcta5',]
 
+# Only these members of each downloaded zip file are extracted. The rest,
+# like the large .xml metadata files, are never read by parse_shapefiles.py.
+EXTRACT_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg',]
+
 
 STATE_FIPS_DICT = {
     '01': {
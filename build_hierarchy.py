@@ -0,0 +1,296 @@
+'''
+After you run `fetch_shapefiles.py`, this script will work out how the
+geographies nest inside each other: which counties each place is in, which
+congressional districts each county is in, and so on for each pair of
+geography types in HIERARCHY_PAIRS. Most of these relationships aren't in
+the TIGER attributes, so they are found by intersecting the polygons.
+
+The output csv, written to `CSV_DIR`, has a row for each child geography
+and each parent it overlaps, with their `FULL_GEOID`s and the fraction of
+the child's area that falls inside the parent. Overlaps smaller than
+MIN_OVERLAP are left out, since they're usually just slight differences
+between the boundaries of the two layers; pass --min-overlap to change it.
+Pairs of polygons GEOS can't intersect, even after repairing them with
+make_valid, are logged and left out.
+
+    >> python build_hierarchy.py
+    >> python build_hierarchy.py -s WA
+    >> python build_hierarchy.py --min-overlap 0.01
+
+Pass -s to only load geographies for one state, which writes
+`hierarchy_<state>.csv` instead of `hierarchy.csv`, and -z to read the
+shapefiles straight out of the zip files in `DOWNLOAD_DIR`.
+
+Needs shapely 2 (`pip install shapely`). Each parent layer is loaded into
+an index of bounding boxes (see `helpers/spatial_helpers.py`), so each
+child is only tested against the few parents whose boxes overlap its own,
+rather than all of them. The exact intersections are worked out by a pool
+of worker processes, one per CPU by default; pass -j to change how many.
+The output is the same either way.
+
+    >> python build_hierarchy.py -j 8
+'''
+
+import csv, optparse, os, sys
+import multiprocessing
+from functools import partial
+from os.path import isdir, join, normpath
+
+try:
+    import numpy
+    import shapely
+    from shapely.errors import GEOSException
+except ImportError:
+    numpy = shapely = None
+
+from __init__ import CSV_DIR, STATE_ABBREV_LIST
+from helpers import spatial_helpers
+from helpers.pool_helpers import map_ordered
+from helpers.spatial_helpers import (get_indexes, init_worker,
+    load_polygon_indexes, set_indexes)
+
+# (child, parent) geography types to relate
+HIERARCHY_PAIRS = [
+    ('place', 'county'),
+    ('place', 'cd'),
+    ('county', 'cd'),
+    ('elsd', 'county'),
+    ('scsd', 'county'),
+    ('unsd', 'county'),
+    ('sldu', 'county'),
+    ('sldl', 'county'),
+    ('zcta5', 'county'),
+    ('zcta5', 'place'),
+]
+
+# Smallest fraction of a child's area that counts as an overlap
+MIN_OVERLAP = 0.001
+
+# Children are intersected in chunks, by a pool of HIERARCHY_JOBS worker
+# processes. Each pair is split into TASKS_PER_JOB chunks per job, so
+# workers finish at about the same time.
+HIERARCHY_JOBS = multiprocessing.cpu_count()
+TASKS_PER_JOB = 4
+
+
+def _get_geo_types():
+    geo_types = set()
+    for child_type, parent_type in HIERARCHY_PAIRS:
+        geo_types.update([child_type, parent_type])
+    return sorted(geo_types)
+
+
+def get_join_tasks(jobs=HIERARCHY_JOBS):
+    # Returns (child type, parent type, start, stop) tasks covering every
+    # child of every pair with both layers loaded
+    indexes = dict(get_indexes())
+    tasks = []
+    for child_type, parent_type in HIERARCHY_PAIRS:
+        if child_type not in indexes or parent_type not in indexes:
+            continue
+        child_count = len(indexes[child_type])
+        chunks = max(1, min(jobs * TASKS_PER_JOB, child_count))
+        bounds = [child_count * i // chunks for i in range(chunks + 1)]
+        for start, stop in zip(bounds, bounds[1:]):
+            tasks.append((child_type, parent_type, start, stop))
+    return tasks
+
+
+def _get_overlap_area(child, parent):
+    # Area of child inside parent. GEOS can fail on invalid polygons, so
+    # try again with repaired copies, and return None if that fails too.
+    try:
+        return shapely.intersection(child, parent).area
+    except GEOSException:
+        pass
+    try:
+        return shapely.intersection(
+            shapely.make_valid(child), shapely.make_valid(parent)).area
+    except GEOSException:
+        return None
+
+
+def _get_overlap_areas(children, parents, child_ids, parent_ids):
+    # Areas of each child inside its parent, all in one call where GEOS
+    # manages it. Pairs that can't be intersected at all are logged and
+    # get NaN, so they are left out of the output.
+    try:
+        return shapely.area(shapely.intersection(children, parents))
+    except GEOSException:
+        pass
+    areas = numpy.empty(len(children))
+    for i, (child, parent) in enumerate(zip(children, parents)):
+        area = _get_overlap_area(child, parent)
+        if area is None:
+            print("Skipping %s in %s: intersection failed" % (
+                child_ids[i], parent_ids[i]))
+            area = numpy.nan
+        areas[i] = area
+    return areas
+
+
+def _check_pairs(predicate, parents, children, get_pair_ids):
+    # predicate(parent, child), like shapely.contains, for each pair, all
+    # in one call where GEOS manages it, otherwise one pair at a time and
+    # with repaired copies where GEOS fails on the originals. Pairs that
+    # can't be tested at all are logged and count as False.
+    try:
+        return predicate(parents, children)
+    except GEOSException:
+        pass
+    results = numpy.zeros(len(parents), dtype=bool)
+    for i, (parent, child) in enumerate(zip(parents, children)):
+        try:
+            results[i] = predicate(parent, child)
+            continue
+        except GEOSException:
+            pass
+        try:
+            results[i] = predicate(
+                shapely.make_valid(parent), shapely.make_valid(child))
+        except GEOSException:
+            print("Skipping %s in %s: %s failed" % (
+                get_pair_ids(i) + (predicate.__name__,)))
+    return results
+
+
+def join_chunk(task, min_overlap=MIN_OVERLAP):
+    # Returns (child FULL_GEOID, parent FULL_GEOID, overlap fraction) for
+    # each parent overlapping children start to stop - 1. Areas are in
+    # square degrees, which is fine for the fraction of a single child.
+    child_type, parent_type, start, stop = task
+    indexes = dict(get_indexes())
+    children = indexes[child_type]
+    parents = indexes[parent_type]
+
+    # Every (child, parent) pair that intersects at all, tested against
+    # the prepared parents in one query, in child then parent order
+    child_geometries = children.geometries[start:stop]
+    child_areas = shapely.area(child_geometries)
+    get_pair_ids = lambda i: (
+        children.ids[start + positions[i]], parents.ids[matches[i]])
+    try:
+        positions, matches = parents.query(
+            child_geometries, predicate='intersects')
+    except GEOSException:
+        # Some polygon is invalid; test the pairs whose bounding boxes
+        # overlap separately instead
+        positions, matches = parents.query(child_geometries)
+        intersecting = _check_pairs(
+            shapely.intersects, parents.geometries[matches],
+            child_geometries[positions], get_pair_ids)
+        positions, matches = positions[intersecting], matches[intersecting]
+    has_area = child_areas[positions] > 0
+    positions, matches = positions[has_area], matches[has_area]
+
+    pair_children = child_geometries[positions]
+    pair_parents = parents.geometries[matches]
+    fractions = numpy.ones(len(positions))
+    partial_overlaps = numpy.flatnonzero(~_check_pairs(
+        shapely.contains, pair_parents, pair_children, get_pair_ids))
+    if len(partial_overlaps):
+        overlap_areas = _get_overlap_areas(
+            pair_children[partial_overlaps], pair_parents[partial_overlaps],
+            [children.ids[start + i]
+             for i in positions[partial_overlaps].tolist()],
+            [parents.ids[j] for j in matches[partial_overlaps].tolist()])
+        fractions[partial_overlaps] = numpy.minimum(
+            overlap_areas / child_areas[positions[partial_overlaps]], 1.0)
+
+    return [
+        (children.ids[start + i], parents.ids[j], fraction)
+        for i, j, fraction in zip(
+            positions.tolist(), matches.tolist(), fractions.tolist())
+        if fraction >= min_overlap
+    ]
+
+
+def build_hierarchy(state=None, from_zip=False, min_overlap=MIN_OVERLAP,
+                    jobs=HIERARCHY_JOBS):
+    geo_types = _get_geo_types()
+    set_indexes(load_polygon_indexes(
+        state=state, geo_types=geo_types, from_zip=from_zip))
+    tasks = get_join_tasks(jobs=jobs)
+    if not tasks:
+        print("No pairs of geography types found to relate")
+        return
+
+    output_state = '_%s' % state if state else ''
+    csvpath = normpath(join(CSV_DIR, 'hierarchy%s.csv' % output_state))
+    csvfile = open(csvpath, 'w')
+
+    print("Writing: " + csvpath + " ...\n")
+    csvwriter = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
+    csvwriter.writerow([
+        'CHILD_FULL_GEOID', 'PARENT_FULL_GEOID', 'OVERLAP_FRACTION',
+    ])
+    join_rows = partial(join_chunk, min_overlap=min_overlap)
+    for rows in map_ordered(
+            join_rows, tasks, jobs, initializer=init_worker,
+            initargs=(state, geo_types, from_zip)):
+        csvwriter.writerows(
+            (child, parent, '%.6f' % fraction)
+            for child, parent, fraction in rows)
+    csvfile.close()
+
+
+def process_options(arglist=None):
+    global options, args
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-s', '--state',
+        dest='state',
+        default=None,
+        help='only relate geographies in this state',
+        choices=STATE_ABBREV_LIST,
+    )
+    parser.add_option(
+        '-z', '--zipped',
+        action='store_true',
+        dest='from_zip',
+        help='read shapefiles directly from the zip files in DOWNLOAD_DIR'
+    )
+    parser.add_option(
+        '--min-overlap',
+        dest='min_overlap',
+        type='float',
+        help='smallest fraction of a child\'s area to count as an overlap',
+        default=MIN_OVERLAP
+    )
+    parser.add_option(
+        '-j', '--jobs',
+        dest='jobs',
+        type='int',
+        help='number of processes intersecting polygons',
+        default=HIERARCHY_JOBS
+    )
+    options, args = parser.parse_args(arglist)
+    if spatial_helpers.shapely is None:
+        parser.error('build_hierarchy.py needs shapely 2')
+    return options, args
+
+
+def main(args=None):
+    """
+    >> python build_hierarchy.py
+    >> python build_hierarchy.py -s WA
+    >> python build_hierarchy.py -j 8 --min-overlap 0.01
+    """
+    if args is None:
+        args = sys.argv[1:]
+    options, args = process_options(args)
+
+    # make sure we have the expected directories
+    if not isdir(CSV_DIR):
+        os.makedirs(CSV_DIR)
+
+    build_hierarchy(
+        state=options.state,
+        from_zip=options.from_zip,
+        min_overlap=options.min_overlap,
+        jobs=options.jobs,
+    )
+
+
+if __name__ == '__main__':
+    main()
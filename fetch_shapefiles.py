@@ -12,6 +12,62 @@ from 2012 to something else (e.g. 2015).
     >> python fetch_shapefiles.py -y 2015
     >> python fetch_shapefiles.py -s WA -g place -y 2015
 
+The -s and -g arguments also take comma-separated lists. Every directory is
+listed once, and all of the files are fetched in a single download session.
+Pass "all" to -s or -g to include every state or every geography type.
+
+    >> python fetch_shapefiles.py -s WA,OR,ID -g place,county
+    >> python fetch_shapefiles.py -s all -g place,elsd,scsd,unsd,sldl
+
+Files come from the Census FTP server by default. Pass --source to fetch them
+from somewhere else: an https:// URL, another ftp:// URL, or a local mirror
+of the same directory layout given as a file:// URL or a directory path.
+With -y, a `TIGER2012` directory in the source is swapped for that year's;
+other sources are used as given. Connections are kept open and reused from
+one file to the next.
+
+    >> python fetch_shapefiles.py --source https://www2.census.gov/geo/tiger/TIGER2012/
+    >> python fetch_shapefiles.py --source /mnt/mirror/TIGER2012/
+
+Files are downloaded to a temporary .part file and only moved into place once
+complete. If a download is interrupted, the next attempt (or the next run)
+resumes from the end of the .part file rather than starting over.
+
+Several files are downloaded at once. Pass a -j argument to change how many
+(default 4), and a --per-host argument to cap the number of simultaneous
+connections made to any one server. Download speed in MB/s is reported for
+each file as it finishes, and for the whole run every few seconds.
+
+    >> python fetch_shapefiles.py -j 8 --per-host 4
+
+The largest files are downloaded first, so the run doesn't end with one
+long download while the other workers sit idle. Pass --plan to see which
+files would be downloaded, their total size, and an estimated time, without
+downloading anything. The estimate uses the speed measured on the last run,
+or pass --bandwidth to give one in MB/s.
+
+    >> python fetch_shapefiles.py -s all --plan
+    >> python fetch_shapefiles.py -g zcta5 --plan --bandwidth 25
+
+Each file is extracted as soon as its download finishes, by a pool of worker
+processes (one per CPU by default), while the remaining files keep
+downloading. Pass --extract-jobs to change the number of extraction processes.
+Pass --no-extract to skip extraction and leave the zip files as they are;
+parse_shapefiles.py -z can read shapefiles directly from them.
+
+Only the parts of each zip file that parse_shapefiles.py reads are extracted
+(see EXTRACT_EXTENSIONS), and files already extracted with a matching size
+and CRC are left alone, so re-running over a populated EXTRACT_DIR is quick.
+
+fetch_shapefiles.py keeps a manifest of remote directory listings, and of the
+size and date of each file it downloads, in DOWNLOAD_DIR/manifest.json.
+Listings fetched within the last day are reused without contacting the
+server, and a file you already have is downloaded again only if its size
+or date in the listing has changed. Pass --manifest-ttl to change how long
+listings are reused, in seconds, or --manifest-ttl 0 to always re-list.
+
+    >> python fetch_shapefiles.py --manifest-ttl 0
+
 If you use the -s argument to fetch files for a single state, the script
 will also download the national county, state and congressional district
 files that include data for your chosen state.
@@ -29,37 +85,105 @@ in GEO_TYPES_LIST specifically, however. So to fetch the ZCTA data:
     >> python fetch_shapefiles.py -g zcta5
 '''
 
+import multiprocessing
 import optparse
 import os
+import shutil
 import sys
+import threading
+import time
 import zipfile
+import zlib
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from os.path import isdir, join, normpath
 
 try:
-    from six.moves.urllib import request as urllib2
+    from six.moves import queue
 except ImportError:
-    import urllib2
+    import Queue as queue
 
 from __init__ import (DOWNLOAD_DIR, EXTRACT_DIR, STATE_ABBREV_LIST,
                       GEO_TYPES_LIST, DISABLE_AUTO_DOWNLOADS,
-                      get_fips_code_for_state)
+                      EXTRACT_EXTENSIONS, get_fips_code_for_state)
+from helpers.manifest_helpers import Manifest
+from helpers.transport_helpers import get_transport
 
+# Default source for TIGER files. Pass --source to use another server, such
+# as https://www2.census.gov/geo/tiger/TIGER2012/, or a local mirror of
+# the same directory tree as a file:// URL or a directory path.
 FTP_HOME = 'ftp://ftp2.census.gov/geo/tiger/TIGER2012/'
 
+# Number of files fetched at once, and the most connections any one
+# host will see at a time. Override with -j and --per-host.
+DOWNLOAD_JOBS = 4
+MAX_CONNECTIONS_PER_HOST = 4
+
+# Downloads are written to a .part file and resumed from where they left
+# off, up to DOWNLOAD_RETRIES times, when a connection drops or stalls
+# for longer than DOWNLOAD_TIMEOUT seconds.
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_TIMEOUT = 60
+
+# Downloads are copied through one preallocated buffer. Reads start at
+# MIN_BLOCK_SIZE bytes and double, up to MAX_BLOCK_SIZE, while each read
+# fills the block. Overall progress is printed every PROGRESS_INTERVAL
+# seconds.
+MIN_BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+PROGRESS_INTERVAL = 5
+
+# Used by --plan to estimate download time, in MB/s, when there is no
+# throughput measured by an earlier run in the manifest.
+DEFAULT_BANDWIDTH = 10
+
+# Finished downloads are extracted by a pool of EXTRACT_JOBS processes
+# while other files are still downloading. At most EXTRACT_QUEUE_SIZE
+# zip files wait for extraction; downloads pause once the queue is full.
+EXTRACT_JOBS = multiprocessing.cpu_count()
+EXTRACT_QUEUE_SIZE = 8
+
+# Remote directory listings and the size/date of each downloaded file are
+# recorded in DOWNLOAD_DIR/MANIFEST_FILENAME. Listings younger than
+# MANIFEST_TTL seconds are reused without contacting the server.
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_TTL = 24 * 60 * 60
+
+
+def get_listing_from_ftp(target, manifest=None, transport=None):
+    entries = manifest.get_listing(target) if manifest else None
+    if entries is None:
+        transport = transport or get_transport(target, DOWNLOAD_TIMEOUT)
+        entries = transport.list_directory(target)
+        if manifest:
+            manifest.set_listing(target, entries)
+            manifest.save()
+    else:
+        print("Using cached listing for: " + target)
+
+    return entries
 
-def get_filename_list_from_ftp(target, state):
-    target_files = urllib2.urlopen(target).read().splitlines()
+
+def get_filename_list_from_ftp(target, state, manifest=None, transport=None):
     filename_list = []
 
-    for line in target_files:
-        filename = '%s%s' % (target, line.decode().split()[-1])
+    for entry in get_listing_from_ftp(target, manifest, transport):
+        filename = '%s%s' % (target, entry['name'])
         filename_list.append(filename)
 
+    return filter_filename_list(filename_list, state)
+
+
+def filter_filename_list(filename_list, state):
+    # state may be a single state or a list of them
     if state:
-        state_check = '_%s_' % get_fips_code_for_state(state)
+        states = [state] if isinstance(state, str) else state
+        state_checks = [
+            '_%s_' % get_fips_code_for_state(_state) for _state in states
+        ]
         filename_list = filter(
             lambda filename:
-                state_check in filename or
+                any(state_check in filename for state_check in state_checks) or
                 ('_us_' in filename and
                  '_us_zcta5' not in filename),
             filename_list
@@ -68,51 +192,330 @@ def get_filename_list_from_ftp(target, state):
     return filename_list
 
 
-def get_content_length(u):
-    # u is returned by urllib2.urlopen
-    if sys.version_info[0] == 2:
-        return int(u.info().getheader("Content-Length"))
-    else:
-        return int(u.headers["Content-Length"])
-
+def _format_rate(nbytes, elapsed):
+    return '%.2f MB/s' % (nbytes / 1e6 / max(elapsed, 1e-6))
+
+
+class DownloadProgress(object):
+    '''
+    Thread-safe tally of the files and bytes fetched by worker threads.
+    Each finished file is reported along with totals for the run, and
+    overall throughput is printed at most once every interval seconds.
+    '''
+    def __init__(self, file_count, interval=PROGRESS_INTERVAL):
+        self.lock = threading.Lock()
+        self.file_count = file_count
+        self.files_done = 0
+        self.bytes_done = 0
+        self.bytes_transferred = 0
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def file_started(self, filename, file_size):
+        with self.lock:
+            print("Downloading: %s Bytes: %s" % (filename, file_size))
 
-def download_files_in_list(filename_list, force=False):
+    def update(self, nbytes):
+        with self.lock:
+            self.bytes_transferred += nbytes
+            now = time.time()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            print("Progress: %d of %d files, %.1f MB transferred, %s" % (
+                self.files_done, self.file_count, self.bytes_transferred / 1e6,
+                _format_rate(self.bytes_transferred, now - self.start_time)))
+
+    def file_finished(self, filename, file_size, transferred, elapsed):
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += file_size
+            print("Downloaded: %s [%s; %d of %d files, %d bytes total]" % (
+                filename, _format_rate(transferred, elapsed),
+                self.files_done, self.file_count, self.bytes_done))
+
+    def get_throughput(self):
+        # Bytes per second across the whole session so far
+        return self.bytes_transferred / max(time.time() - self.start_time, 1e-6)
+
+    def finish(self):
+        if self.files_done:
+            elapsed = time.time() - self.start_time
+            print("Downloaded %d files, %.1f MB in %.1f seconds, %s" % (
+                self.files_done, self.bytes_transferred / 1e6, elapsed,
+                _format_rate(self.bytes_transferred, elapsed)))
+
+
+def copy_stream(source, dest, callback=None):
+    # Read into a single preallocated buffer instead of allocating a new
+    # bytes object per block, growing the block size while reads keep
+    # filling it. Returns the number of bytes copied.
+    buffer = bytearray(MAX_BLOCK_SIZE)
+    view = memoryview(buffer)
+    readinto = getattr(source, 'readinto', None)
+    block_sz = MIN_BLOCK_SIZE
+    copied = 0
+    while True:
+        if readinto:
+            nbytes = readinto(view[:block_sz])
+            if not nbytes:
+                break
+            dest.write(view[:nbytes])
+        else:
+            data = source.read(block_sz)
+            if not data:
+                break
+            nbytes = len(data)
+            dest.write(data)
+
+        copied += nbytes
+        if callback:
+            callback(nbytes)
+        if nbytes == block_sz and block_sz < MAX_BLOCK_SIZE:
+            block_sz *= 2
+    return copied
+
+
+def download_file(file_location, filename, progress, transport,
+                  retries=DOWNLOAD_RETRIES):
+    # Write to a .part file and only move it into place once complete,
+    # so a file at its final path is always a whole download.
+    part_filename = filename + '.part'
+    for attempt in range(retries + 1):
+        offset = 0
+        if os.path.exists(part_filename):
+            offset = os.path.getsize(part_filename)
+
+        try:
+            u, file_size, offset = transport.open(file_location, offset)
+            if attempt == 0:
+                progress.file_started(filename, file_size)
+            if offset > file_size:
+                # Remote file shrank since the partial download started
+                u.close()
+                os.remove(part_filename)
+                continue
+
+            f = open(part_filename, 'ab' if offset else 'wb')
+            start_time = time.time()
+            try:
+                transferred = copy_stream(u, f, progress.update)
+            finally:
+                f.close()
+                u.close()
+            file_size_dl = offset + transferred
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print("Retrying: %s (%s)" % (filename, e))
+            continue
+
+        if file_size_dl != file_size:
+            if attempt == retries:
+                raise Exception("Incomplete download of %s: %d of %d bytes" % (
+                    file_location, file_size_dl, file_size))
+            print("Resuming: %s at %d of %d bytes" % (
+                filename, file_size_dl, file_size))
+            continue
+
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(part_filename, filename)
+        progress.file_finished(filename, file_size_dl, transferred,
+                               time.time() - start_time)
+        return
+
+    # Only reached if the remote file shrank on the last attempt
+    raise Exception("Remote file changed during download of %s" % file_location)
+
+
+def get_local_filename(file_location):
+    return '%s/%s' % (DOWNLOAD_DIR, file_location.split('/')[-1])
+
+
+def needs_download(file_location, filename, force=False, manifest=None):
+    if force or not os.path.exists(filename):
+        return True
+    return manifest is not None and manifest.is_stale(file_location, filename)
+
+
+def get_remote_sizes(filename_list, listed_sizes, transport, jobs=DOWNLOAD_JOBS,
+                     manifest=None):
+    # Use sizes from the directory listings where we have them, and ask
+    # the server (FTP SIZE and MDTM, or HTTP HEAD) for the rest, a few at
+    # a time. With a manifest, files are also asked about when the listing
+    # has no date for them, whether or not they are on disk, so it can
+    # tell when one is republished at the same size. What the server says
+    # is recorded in the manifest's cached listing, so later runs don't
+    # ask again until the listing expires.
+    if manifest is not None:
+        missing = [
+            file_location for file_location in filename_list
+            if manifest.needs_stat(file_location)
+        ]
+    else:
+        missing = [
+            file_location for file_location in filename_list
+            if listed_sizes.get(file_location) is None and
+            not os.path.exists(get_local_filename(file_location))
+        ]
+    sizes = dict(
+        (file_location, listed_sizes.get(file_location))
+        for file_location in filename_list
+    )
+    def get_stat(file_location):
+        try:
+            return transport.stat(file_location)
+        except Exception:
+            return None
+
+    if missing:
+        pool = ThreadPool(max(1, min(jobs, len(missing))))
+        try:
+            stats = pool.map(get_stat, missing)
+        finally:
+            pool.close()
+        for file_location, stat in zip(missing, stats):
+            if stat is None:
+                continue
+            sizes[file_location] = stat['size']
+            if manifest:
+                manifest.update_remote_entry(file_location, stat)
+        if manifest:
+            manifest.save()
+    return sizes
+
+
+def download_files_in_list(filename_list, force=False, jobs=DOWNLOAD_JOBS,
+                           per_host=MAX_CONNECTIONS_PER_HOST, manifest=None,
+                           on_complete=None, transport=None, sizes=None):
+    # on_complete, if given, is called with each local filename as soon as
+    # that file is available, whether it was downloaded or already present.
+    # If sizes maps file locations to byte counts, the largest files are
+    # started first so no single long download is left running at the end.
     downloaded_filename_list = []
+    work_list = []
+    download_count = 0
     for file_location in filename_list:
-        filename = '%s/%s' % (DOWNLOAD_DIR, file_location.split('/')[-1])
-        if force or not os.path.exists(filename):
-            # Only download if required.
-            u = urllib2.urlopen(file_location)
-            f = open(filename, 'wb')
-            file_size = get_content_length(u)
-
-            print("Downloading: %s Bytes: %s" % (filename, file_size))
-            file_size_dl = 0
-            block_sz = 8192
-            while True:
-                buffer = u.read(block_sz)
-                if not buffer:
-                    break
-
-                file_size_dl += len(buffer)
-                f.write(buffer)
-                status = r"%10d  [%3.2f%%]" % (
-                    file_size_dl, file_size_dl * 100. / file_size)
-                status = status + chr(8) * (len(status) + 1)
-                sys.stdout.write(status)
-                sys.stdout.flush()
-
-            f.close()
+        filename = get_local_filename(file_location)
+        stale = (manifest is not None and os.path.exists(filename) and
+                 manifest.is_stale(file_location, filename))
+        if stale and os.path.exists(filename + '.part'):
+            # Don't resume a partial copy of the old remote file
+            os.remove(filename + '.part')
+        # Only download if required.
+        download = force or stale or not os.path.exists(filename)
+        if download:
+            download_count += 1
+        work_list.append((file_location, filename, download))
         downloaded_filename_list.append(filename)
 
+    # Files already on disk first, since they need no download, then
+    # largest first
+    if sizes:
+        work_list.sort(key=lambda work: (
+            work[2], -(sizes.get(work[0]) or 0)))
+    work_queue = queue.Queue()
+    for work in work_list:
+        work_queue.put(work)
+
+    progress = DownloadProgress(download_count)
+    errors = []
+    own_transport = transport is None and download_count > 0
+    if own_transport:
+        transport = get_transport(
+            filename_list[0], DOWNLOAD_TIMEOUT, per_host)
+
+    def worker():
+        while True:
+            try:
+                file_location, filename, download = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            if download:
+                # The transport makes workers wait for a connection once a
+                # host already has per_host of them open
+                try:
+                    download_file(
+                        file_location, filename, progress, transport)
+                    if manifest:
+                        manifest.record_download(file_location, filename)
+                except Exception as e:
+                    errors.append((file_location, e))
+                    continue
+            if on_complete:
+                on_complete(filename)
+
+    threads = [
+        threading.Thread(target=worker)
+        for _ in range(max(1, min(jobs, download_count)))
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if own_transport:
+        transport.close()
+    if manifest:
+        if progress.files_done:
+            manifest.record_throughput(progress.get_throughput())
+        manifest.save()
+    progress.finish()
+
+    if errors:
+        raise Exception("Failed to download %d file(s): %s" % (
+            len(errors),
+            ', '.join('%s (%s)' % (location, e) for location, e in errors)))
+
     return downloaded_filename_list
 
 
-def extract_downloaded_file(filename, remove_on_error=True):
+def _get_file_crc(path, block_sz=1024 * 1024):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            buffer = f.read(block_sz)
+            if not buffer:
+                break
+            crc = zlib.crc32(buffer, crc)
+    return crc & 0xffffffff
+
+
+def _is_extracted(target_dir, info):
+    # True if this zip member is already on disk with the same size and CRC
+    path = join(target_dir, os.path.basename(info.filename))
+    return (os.path.exists(path) and
+            os.path.getsize(path) == info.file_size and
+            _get_file_crc(path) == info.CRC)
+
+
+def _extract_member(zipped, info, target_dir):
+    # Reading the member through zipfile checks it against its CRC, so
+    # write to a temporary file and only replace the old copy if that passes
+    path = join(target_dir, os.path.basename(info.filename))
+    tmp_path = path + '.tmp'
+    source = zipped.open(info)
+    try:
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(source, f, 1024 * 1024)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        source.close()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def extract_downloaded_file(filename, remove_on_error=True,
+                            extensions=EXTRACT_EXTENSIONS):
     zip_dir = filename.replace('.zip', '').split('/')[-1]
     target_dir = normpath(join(EXTRACT_DIR, zip_dir))
 
-    print("Extracting: " + filename + " ...")
     try:
         zipped = zipfile.ZipFile(filename, 'r')
     except zipfile.BadZipFile as ze:
@@ -122,28 +525,210 @@ def extract_downloaded_file(filename, remove_on_error=True):
                 "Removed corrupt zip file (%s). Retry download." % filename)
         raise ze
 
-    zipped.extractall(target_dir)
-    zipped.close()
-
-
-def get_one_geo_type(geo_type, state=None, year='2012'):
-    target = '%s%s/' % (FTP_HOME.replace('2012', year), geo_type.upper())
-
-    print("Finding files in: " + target + " ...")
-    filename_list = get_filename_list_from_ftp(target, state)
-    downloaded_filename_list = download_files_in_list(filename_list)
-
-    for filename in downloaded_filename_list:
+    try:
+        members = [
+            info for info in zipped.infolist()
+            if os.path.splitext(info.filename)[1].lower() in extensions
+        ]
+        if not isdir(target_dir):
+            os.makedirs(target_dir)
+
+        # Check the CRCs of any copies already on disk in parallel, and
+        # only extract the members that are missing or different
+        pool = ThreadPool(max(1, len(members)))
+        try:
+            extracted = pool.map(
+                lambda info: _is_extracted(target_dir, info), members)
+        finally:
+            pool.close()
+        changed = [
+            info for info, is_extracted in zip(members, extracted)
+            if not is_extracted
+        ]
+
+        if not changed:
+            print("Up to date: " + filename)
+            return
+        print("Extracting: " + filename + " ...")
+        for info in changed:
+            _extract_member(zipped, info, target_dir)
+    finally:
+        zipped.close()
+
+
+def _extract_file_in_pool(filename):
+    # Runs in an ExtractionPipeline worker process. Errors are returned
+    # rather than raised so the pipeline always gets its callback.
+    try:
         extract_downloaded_file(filename)
+    except Exception as e:
+        return '%s (%s)' % (filename, e)
+    return None
+
+
+class ExtractionPipeline(object):
+    '''
+    Extracts zip files in a pool of worker processes as soon as they are
+    submitted, so extraction overlaps with downloads still in progress.
+    submit() blocks while queue_size files are already waiting on top of
+    the jobs being extracted.
+    '''
+    def __init__(self, jobs=EXTRACT_JOBS, queue_size=EXTRACT_QUEUE_SIZE):
+        jobs = max(1, jobs)
+        self.pool = multiprocessing.Pool(jobs)
+        # Files being extracted hold a slot until they finish, as well as
+        # those waiting
+        self.slots = threading.BoundedSemaphore(jobs + queue_size)
+        self.errors = []
+
+    def _done(self, error):
+        if error:
+            self.errors.append(error)
+        self.slots.release()
+
+    def _failed(self, filename, exception):
+        # The task itself failed, e.g. a worker couldn't unpickle it, so
+        # _done is never called
+        self._done('%s (%s)' % (filename, exception))
+
+    def submit(self, filename):
+        self.slots.acquire()
+        kwargs = {'callback': self._done}
+        # error_callback is new in Python 3
+        if sys.version_info[0] >= 3:
+            kwargs['error_callback'] = partial(self._failed, filename)
+        self.pool.apply_async(_extract_file_in_pool, (filename,), **kwargs)
+
+    def join(self):
+        self.pool.close()
+        self.pool.join()
+        if self.errors:
+            raise Exception("Failed to extract %d file(s): %s" % (
+                len(self.errors), ', '.join(self.errors)))
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def print_download_plan(filename_list, sizes, manifest=None, bandwidth=None):
+    # bandwidth is in MB/s; default to what the last run measured
+    if bandwidth is None:
+        throughput = manifest.get_throughput() if manifest else None
+        bandwidth = throughput / 1e6 if throughput else DEFAULT_BANDWIDTH
+
+    planned = sorted(
+        filename_list, key=lambda file_location: -(sizes[file_location] or 0))
+    total_bytes = 0
+    download_count = 0
+    for file_location in planned:
+        filename = get_local_filename(file_location)
+        if needs_download(file_location, filename, manifest=manifest):
+            status = 'download'
+            download_count += 1
+            total_bytes += sizes[file_location] or 0
+        else:
+            status = 'have'
+        print("%-8s %14s  %s" % (
+            status, sizes[file_location] or '?', file_location))
+
+    print("Files to download: %d of %d" % (download_count, len(planned)))
+    print("Total bytes: %d (%.1f MB)" % (total_bytes, total_bytes / 1e6))
+    print("Estimated time: %.0f seconds at %.2f MB/s" % (
+        total_bytes / 1e6 / bandwidth, bandwidth))
+
+
+def get_source_for_year(source, year):
+    # Point a source laid out like the Census server at another year by
+    # replacing its TIGER2012 path segment. Sources without one are used
+    # as they are.
+    segments = source.rstrip('/').split('/')
+    segments = [
+        'TIGER%s' % year if segment == 'TIGER2012' else segment
+        for segment in segments
+    ]
+    return '/'.join(segments) + '/'
+
+
+def get_geo_types(geo_types, state=None, year='2012', jobs=DOWNLOAD_JOBS,
+                  per_host=MAX_CONNECTIONS_PER_HOST, manifest=None,
+                  extract_jobs=EXTRACT_JOBS, extract=True, source=FTP_HOME,
+                  transport=None, plan=False, bandwidth=None):
+    # List each geo type's directory once, then fetch every matching file
+    # for every state in one download session, sharing connections and
+    # one extraction pipeline. With plan=True, only print what would be
+    # downloaded.
+    own_transport = transport is None
+    if own_transport:
+        transport = get_transport(source, DOWNLOAD_TIMEOUT, per_host)
+    pipeline = None
 
-
-def get_all_geo_types(state=None, year='2012'):
+    try:
+        filename_list = []
+        listed_sizes = {}
+        for geo_type in geo_types:
+            target = '%s%s/' % (get_source_for_year(source, year),
+                                geo_type.upper())
+            print("Finding files in: " + target + " ...")
+            for entry in get_listing_from_ftp(target, manifest, transport):
+                file_location = '%s%s' % (target, entry['name'])
+                listed_sizes[file_location] = entry['size']
+                if file_location not in filename_list:
+                    filename_list.append(file_location)
+        filename_list = list(filter_filename_list(filename_list, state))
+        sizes = get_remote_sizes(
+            filename_list, listed_sizes, transport, jobs, manifest=manifest)
+
+        if plan:
+            print_download_plan(filename_list, sizes, manifest, bandwidth)
+            return
+
+        if extract:
+            pipeline = ExtractionPipeline(jobs=extract_jobs)
+        download_files_in_list(
+            filename_list, jobs=jobs, per_host=per_host, manifest=manifest,
+            on_complete=pipeline.submit if extract else None,
+            transport=transport, sizes=sizes)
+    except:
+        if pipeline:
+            pipeline.terminate()
+        raise
+    finally:
+        if own_transport:
+            transport.close()
+
+    if pipeline:
+        pipeline.join()
+
+
+def get_one_geo_type(geo_type, state=None, year='2012', **kwargs):
+    get_geo_types([geo_type], state, year, **kwargs)
+
+
+def get_all_geo_types(state=None, year='2012', **kwargs):
     AUTO_DOWNLOADS = filter(
         lambda geo_type: geo_type not in DISABLE_AUTO_DOWNLOADS,
         GEO_TYPES_LIST
     )
-    for geo_type in AUTO_DOWNLOADS:
-        get_one_geo_type(geo_type, state, year)
+    get_geo_types(list(AUTO_DOWNLOADS), state, year, **kwargs)
+
+
+def _split_list_option(option, opt_str, value, parser, choices):
+    # Accept comma-separated values, and repeated flags, for -s and -g.
+    # The value "all" clears the list, meaning no filter at all.
+    values = getattr(parser.values, option.dest) or []
+    for item in value.split(','):
+        item = item.strip()
+        if item.lower() == 'all':
+            setattr(parser.values, option.dest, None)
+            return
+        if item not in choices:
+            raise optparse.OptionValueError(
+                "option %s: invalid choice: %r (choose from %s)" % (
+                    opt_str, item, ', '.join(choices)))
+        if item not in values:
+            values.append(item)
+    setattr(parser.values, option.dest, values)
 
 
 def process_options(arglist=None):
@@ -151,16 +736,22 @@ def process_options(arglist=None):
     parser = optparse.OptionParser()
     parser.add_option(
         '-s', '--state',
-        dest='state',
-        help='specific state to download',
-        choices=STATE_ABBREV_LIST,
+        dest='states',
+        help='state or comma-separated states to download, or "all"',
+        type='string',
+        action='callback',
+        callback=_split_list_option,
+        callback_args=(STATE_ABBREV_LIST,),
         default=None
     )
     parser.add_option(
         '-g', '--geo', '--geo_type',
-        dest='geo_type',
-        help='specific geographic type to download',
-        choices=GEO_TYPES_LIST,
+        dest='geo_types',
+        help='geographic type or comma-separated types to download, or "all"',
+        type='string',
+        action='callback',
+        callback=_split_list_option,
+        callback_args=(GEO_TYPES_LIST,),
         default=None
     )
     parser.add_option(
@@ -169,6 +760,61 @@ def process_options(arglist=None):
         help='specific year to download',
         default='2012'
     )
+    parser.add_option(
+        '--source',
+        dest='source',
+        help='ftp://, http(s):// or file:// URL, or directory, to fetch from',
+        default=FTP_HOME
+    )
+    parser.add_option(
+        '-j', '--jobs',
+        dest='jobs',
+        type='int',
+        help='number of files to download at once',
+        default=DOWNLOAD_JOBS
+    )
+    parser.add_option(
+        '--per-host',
+        dest='per_host',
+        type='int',
+        help='maximum simultaneous connections to a single host',
+        default=MAX_CONNECTIONS_PER_HOST
+    )
+    parser.add_option(
+        '--extract-jobs',
+        dest='extract_jobs',
+        type='int',
+        help='number of processes extracting downloaded files',
+        default=EXTRACT_JOBS
+    )
+    parser.add_option(
+        '--no-extract',
+        action='store_true',
+        dest='no_extract',
+        help='only download; parse_shapefiles.py -z reads the zip files directly',
+        default=False
+    )
+    parser.add_option(
+        '--plan',
+        action='store_true',
+        dest='plan',
+        help='print the files, total size and estimated time, then exit',
+        default=False
+    )
+    parser.add_option(
+        '--bandwidth',
+        dest='bandwidth',
+        type='float',
+        help='MB/s used by --plan to estimate download time',
+        default=None
+    )
+    parser.add_option(
+        '--manifest-ttl',
+        dest='manifest_ttl',
+        type='int',
+        help='seconds to reuse cached remote directory listings (0 to refresh)',
+        default=MANIFEST_TTL
+    )
 
     options, args = parser.parse_args(arglist)
     return options, args
@@ -180,6 +826,7 @@ def main(args=None):
     >> python fetch_shapefiles.py -s WA
     >> python fetch_shapefiles.py -g place
     >> python fetch_shapefiles.py -s WA -g place
+    >> python fetch_shapefiles.py -s WA,OR -g place,county
     """
     if args is None:
         args = sys.argv[1:]
@@ -190,18 +837,25 @@ def main(args=None):
         if not isdir(path):
             os.makedirs(path)
 
-    # get one geo_type or all geo_types
-    if options.geo_type:
-        get_one_geo_type(
-            geo_type = options.geo_type,
-            state = options.state,
-            year=options.year
-        )
+    manifest = Manifest(join(DOWNLOAD_DIR, MANIFEST_FILENAME),
+                        ttl=options.manifest_ttl)
+
+    # get the chosen geo_types or all geo_types
+    kwargs = dict(
+        year=options.year,
+        jobs=options.jobs,
+        per_host=options.per_host,
+        manifest=manifest,
+        extract_jobs=options.extract_jobs,
+        extract=not options.no_extract,
+        source=options.source,
+        plan=options.plan,
+        bandwidth=options.bandwidth
+    )
+    if options.geo_types:
+        get_geo_types(options.geo_types, options.states, **kwargs)
     else:
-        get_all_geo_types(
-            state = options.state,
-            year=options.year
-        )
+        get_all_geo_types(options.states, **kwargs)
 
 
 if __name__ == '__main__':
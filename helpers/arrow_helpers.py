@@ -0,0 +1,97 @@
+'''
+Helpers for writing parse_shapefiles.py output as Parquet or Arrow IPC
+files instead of csv. Needs pyarrow:
+
+    >> pip install pyarrow
+
+Rows are written in record batches of BATCH_SIZE, with typed columns:
+ALAND is an integer, INTPTLAT and INTPTLON are floats, low-cardinality
+text like GEO_TYPE and REGION_NAME is dictionary-encoded, and WKB
+geometry is stored as binary.
+'''
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from helpers.csv_helpers import FLOAT_FIELDS, INTEGER_FIELDS, to_float, to_int
+from helpers.row_store_helpers import CATEGORICAL_FIELDS
+
+BATCH_SIZE = 65536
+
+
+def _get_column_types(fields, binary_geometry=False):
+    # Returns (arrow type, converter, dictionary-encode?) for each field
+    column_types = []
+    for field in fields:
+        if field in INTEGER_FIELDS:
+            column_types.append((pyarrow.int64(), to_int, False))
+        elif field in FLOAT_FIELDS:
+            column_types.append((pyarrow.float64(), to_float, False))
+        elif field.startswith('GEOMETRY') and binary_geometry:
+            column_types.append((pyarrow.binary(), None, False))
+        elif field in CATEGORICAL_FIELDS:
+            column_types.append((pyarrow.string(), None, True))
+        else:
+            column_types.append((pyarrow.string(), None, False))
+    return column_types
+
+
+def get_schema(fields, binary_geometry=False):
+    return pyarrow.schema([
+        (field, pyarrow.dictionary(pyarrow.int32(), arrow_type)
+            if encode else arrow_type)
+        for field, (arrow_type, _, encode) in zip(
+            fields, _get_column_types(fields, binary_geometry))
+    ])
+
+
+def _make_batch(rows, schema, column_types):
+    arrays = []
+    for i, (arrow_type, converter, encode) in enumerate(column_types):
+        values = [row[i] for row in rows]
+        if converter is not None:
+            values = [converter(value) for value in values]
+        array = pyarrow.array(values, type=arrow_type)
+        if encode:
+            array = array.dictionary_encode()
+        arrays.append(array)
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _iter_batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_arrow(path, rows, fields, output_format='parquet',
+                binary_geometry=False, batch_size=BATCH_SIZE):
+    # rows are sequences of values in fields order
+    if pyarrow is None:
+        raise Exception('pyarrow is needed to write %s files' % output_format)
+
+    column_types = _get_column_types(fields, binary_geometry)
+    schema = get_schema(fields, binary_geometry)
+    if output_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+        write_batch = lambda batch: writer.write_table(
+            pyarrow.Table.from_batches([batch]))
+    elif output_format == 'arrow':
+        writer = pyarrow.ipc.new_file(path, schema)
+        write_batch = writer.write_batch
+    else:
+        raise ValueError('Unknown output format: %s' % output_format)
+
+    try:
+        for batch in _iter_batches(rows, batch_size):
+            write_batch(_make_batch(batch, schema, column_types))
+    finally:
+        writer.close()
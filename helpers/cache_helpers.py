@@ -0,0 +1,100 @@
+'''
+Helpers for caching the results of slow work in parse_shapefiles.py, like
+geometry simplification, between runs.
+
+Each entry is a marshal file under CACHE_DIR, named for a hash of a key
+that includes a fingerprint of the source shapefile, so entries for a
+shapefile are ignored as soon as it is downloaded or extracted again.
+
+    >> key = {'source': get_source_fingerprint(filename), 'tolerance': 0.01}
+    >> path = get_cache_path(CACHE_DIR, 'simplify', key)
+    >> values = load_cache(path)
+    >> if values is None:
+    >>     values = simplify(...)
+    >>     save_cache(path, values)
+
+Entries are only replaced or removed once the shapefile they were built
+from changes or goes away; prune_cache removes those, whatever run made
+them, and leaves every other entry alone.
+'''
+
+import glob
+import hashlib
+import json
+import marshal
+import os
+
+from helpers.file_helpers import replace_file, split_vsizip_path
+
+
+def get_source_fingerprint(filename):
+    # Name, size and modification time of the files a shapefile is read
+    # from: the zip for /vsizip/ paths, otherwise the .shp and .dbf
+    zip_filename, _ = split_vsizip_path(filename)
+    if zip_filename:
+        sources = [zip_filename]
+    else:
+        stem = os.path.splitext(filename)[0]
+        sources = [stem + '.shp', stem + '.dbf']
+
+    fingerprint = [os.path.basename(filename)]
+    for source in sources:
+        stat = os.stat(source)
+        fingerprint.append([
+            os.path.basename(source), stat.st_size, int(stat.st_mtime)])
+    return fingerprint
+
+
+def is_source_current(filename, fingerprint):
+    # Whether filename still has the fingerprint it had when an entry was
+    # built from it
+    try:
+        return get_source_fingerprint(filename) == fingerprint
+    except OSError:
+        return False
+
+
+def get_cache_path(cache_dir, kind, key):
+    # key must be JSON-serializable
+    digest = hashlib.sha1(
+        json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, '%s_%s.cache' % (kind, digest))
+
+
+def load_cache(path):
+    # Returns the cached value, or None if there isn't a usable one
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return marshal.load(f)
+    except (EOFError, ValueError, TypeError):
+        return None
+
+
+def save_cache(path, value):
+    # Caching is only an optimization, so carry on without it if the
+    # directory isn't writable
+    try:
+        replace_file(path, lambda f: marshal.dump(value, f), 'wb')
+    except (IOError, OSError):
+        print("Could not save cache file: " + path)
+
+
+def prune_cache(cache_dir, kind, is_current):
+    # Removes the entries of a kind that can't be read, or that
+    # is_current(entry) rejects. Returns (kept, removed) lists of entries.
+    kept, removed = [], []
+    for path in glob.glob(os.path.join(cache_dir, kind + '_*.cache')):
+        entry = load_cache(path)
+        if entry is not None and is_current(entry):
+            kept.append(entry)
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            # Already removed by another run
+            continue
+        if entry is not None:
+            removed.append(entry)
+    return kept, removed
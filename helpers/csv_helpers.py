@@ -1,8 +1,22 @@
 '''
 Helper functions for making csv files in parse_shapefiles.py
+
+Rows are built by a RowBuilder, compiled once per layer from the geo_type's
+entry in ROW_SPECS, as tuples of values in get_fields_for_csv order.
 '''
 
-def get_fields_for_csv(include_polygon=False):
+import binascii
+
+from osgeo import ogr
+
+# Ways to write the GEOMETRY field. 'wkb' is raw bytes, for binary outputs.
+GEOMETRY_FORMATS = ['wkt', 'wkb-hex', 'wkb', 'geojson',]
+
+def get_simplified_field(tolerance):
+    # Name of the column holding geometry simplified to tolerance
+    return 'GEOMETRY_%g' % tolerance
+
+def get_fields_for_csv(include_polygon=False, simplify=None):
     field_list = [
         'FULL_GEOID',
         'FULL_NAME',
@@ -39,234 +53,265 @@ def get_fields_for_csv(include_polygon=False):
     ]
     if include_polygon:
         field_list.append('GEOMETRY')
+        for tolerance in simplify or []:
+            field_list.append(get_simplified_field(tolerance))
 
     return field_list
 
-def make_basic_row(feature, item, geo_type, item_options):
-    # Set up the dict and populate common fields
-    item.update({
-        'FULL_GEOID': None,
-        'FULL_NAME': None,
-        'SUMLEV': None,
-        'GEO_TYPE': geo_type,
-        'REGION': item_options['state_dict']['region'],
-        'REGION_NAME': item_options['state_dict']['region_name'],
-        'DIVISION': item_options['state_dict']['division'],
-        'DIVISION_NAME': item_options['state_dict']['division_name'],
-        'STATEFP': item_options['statefp'],
-        'GEOID': item_options['geoid'],
-        'CD112FP': None,
-        'CDSESSN': None,
-        'COUNTYFP': None,
-        'PLACEFP': None,
-        'CLASSFP': None,
-        'SLDLST': None,
-        'SLDUST': None,
-        'ELSDLEA': None,
-        'SCSDLEA': None,
-        'UNSDLEA': None,
-        'PCICBSA': None,
-        'PCINECTA': None,
-        'CSAFP': None,
-        'CBSAFP': None,
-        'METDIVFP': None,
-        'ZCTA5CE10': None,
-        'NAME': None,
-        'NAMELSAD': None,
-        'LSAD': None,
-        'ALAND': feature.GetField("ALAND"),
-        'INTPTLAT': feature.GetField("INTPTLAT"),
-        'INTPTLON': feature.GetField("INTPTLON"),
-    })
-    if item_options['include_polygon']:
-        _geom = feature.GetGeometryRef()
-        item.update({
-            'GEOMETRY': str(_geom),
-        })
-    return item
+# Bump this whenever a change to ROW_SPECS or RowBuilder changes the rows
+# built, so rows cached by parse_shapefiles.py are built again
+ROW_BUILDER_VERSION = 1
 
+# Fields written as numbers, rather than text, by outputs with typed columns
+INTEGER_FIELDS = ['REGION', 'DIVISION', 'ALAND',]
+FLOAT_FIELDS = ['INTPTLAT', 'INTPTLON',]
 
-'''
-# the subset of fields that a non-zcta geo_type might update
-def make_foo_row(feature, item, item_options):
-    _sumlev = ''# each geo_type needs to set this
-    _name = ''# each may want to cache this to build FULL_NAME
-    _namelsad = ''# or cache this to build FULL_NAME
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': None,
-        'SUMLEV': _sumlev,
-        'CD112FP': feature.GetField("CD112FP"),
-        'CDSESSN': feature.GetField("CDSESSN"),
-        'COUNTYFP': feature.GetField("COUNTYFP"),
-        'PLACEFP': feature.GetField("PLACEFP"),
-        'CLASSFP': feature.GetField("CLASSFP"),
-        'SLDLST': feature.GetField("SLDLST"),
-        'SLDUST': feature.GetField("SLDUST"),
-        'ELSDLEA': feature.GetField("ELSDLEA"),
-        'SCSDLEA': feature.GetField("SCSDLEA"),
-        'UNSDLEA': feature.GetField("UNSDLEA"),
-        'PCICBSA': feature.GetField("PCICBSA"),
-        'PCINECTA': feature.GetField("PCINECTA"),
-        'CSAFP': feature.GetField("CSAFP"),
-        'CBSAFP': feature.GetField("CBSAFP"),
-        'METDIVFP': feature.GetField("METDIVFP"),
-        'NAME': feature.GetField("NAME"),
-        'NAMELSAD': feature.GetField("NAMELSAD"),
-        'LSAD': feature.GetField("LSAD"),
-    })
-'''
+def to_int(value):
+    return int(value) if value not in (None, '') else None
+
+def to_float(value):
+    # Shapefiles store INTPTLAT/INTPTLON as text like '+47.6062095'
+    return float(value) if value not in (None, '') else None
+
+# Stands in for the name of a feature's state in FULL_NAME templates
+STATE_NAME = None
+
+# Attributes shared by every geo_type except zcta5, which also get their
+# REGION and DIVISION fields from the feature's state
+BASIC_ROW_ATTRIBUTES = ['STATEFP', 'GEOID', 'ALAND', 'INTPTLAT', 'INTPTLON',]
+
+# How each geo_type's shapefile attributes become csv fields:
+# * `sumlev`: Census summary level code
+# * `attributes`: attributes copied into the csv field of the same name,
+# or (csv field, attribute) pairs where the names differ
+# * `full_geoid`: template filled with the GEOID field, if not the usual
+# '<sumlev>00US<GEOID>'
+# * `full_name`: template and the csv fields (or STATE_NAME) that fill it
+# * `basic`: False if the BASIC_ROW_ATTRIBUTES don't apply
+ROW_SPECS = {
+    'cd': {
+        'sumlev': '500',
+        'attributes': ['CD112FP', 'CDSESSN', 'NAMELSAD', 'LSAD',],
+        'full_name': ('%s %s', (STATE_NAME, 'NAMELSAD')),
+    },
+    'county': {
+        'sumlev': '050',
+        'attributes': ['COUNTYFP', 'CLASSFP', 'CSAFP', 'CBSAFP', 'METDIVFP',
+                       'NAME', 'NAMELSAD', 'LSAD',],
+        'full_name': ('%s, %s', ('NAMELSAD', STATE_NAME)),
+    },
+    'elsd': {
+        'sumlev': '950',
+        'attributes': ['ELSDLEA', 'NAME', 'LSAD',],
+        'full_name': ('%s, %s', ('NAME', STATE_NAME)),
+    },
+    'scsd': {
+        'sumlev': '960',
+        'attributes': ['SCSDLEA', 'NAME', 'LSAD',],
+        'full_name': ('%s, %s', ('NAME', STATE_NAME)),
+    },
+    'unsd': {
+        'sumlev': '970',
+        'attributes': ['UNSDLEA', 'NAME', 'LSAD',],
+        'full_name': ('%s, %s', ('NAME', STATE_NAME)),
+    },
+    'sldu': {
+        'sumlev': '610',
+        'attributes': ['SLDUST', 'NAMELSAD', 'LSAD',],
+        'full_name': ('%s %s', (STATE_NAME, 'NAMELSAD')),
+    },
+    'sldl': {
+        'sumlev': '620',
+        'attributes': ['SLDLST', 'NAMELSAD', 'LSAD',],
+        'full_name': ('%s %s', (STATE_NAME, 'NAMELSAD')),
+    },
+    'place': {
+        'sumlev': '160',
+        'attributes': ['PLACEFP', 'CLASSFP', 'PCICBSA', 'PCINECTA', 'NAME',
+                       'NAMELSAD', 'LSAD',],
+        'full_name': ('%s, %s', ('NAME', STATE_NAME)),
+    },
+    'state': {
+        'sumlev': '040',
+        'attributes': ['NAME', 'LSAD',],
+        'full_name': ('%s', ('NAME',)),
+    },
+    'zcta5': {
+        # Zip Code Tabulation Area shapefiles have attrs named differently
+        'sumlev': '860',
+        'attributes': [('GEOID', 'GEOID10'), ('CLASSFP', 'CLASSFP10'),
+                       'ZCTA5CE10', ('ALAND', 'ALAND10'),
+                       ('INTPTLAT', 'INTPTLAT10'), ('INTPTLON', 'INTPTLON10'),],
+        'full_geoid': '860|%s',
+        'full_name': ('ZIP Code: %s', ('ZCTA5CE10',)),
+        'basic': False,
+    },
+}
+
+# csv fields filled from the feature's entry in STATE_FIPS_DICT
+STATE_DICT_FIELDS = [
+    ('REGION', 'region'),
+    ('REGION_NAME', 'region_name'),
+    ('DIVISION', 'division'),
+    ('DIVISION_NAME', 'division_name'),
+]
+
+def _get_attribute_pairs(geo_type):
+    # Returns (csv field, shapefile attribute) pairs for geo_type
+    spec = ROW_SPECS[geo_type]
+    attributes = list(spec['attributes'])
+    if spec.get('basic', True):
+        attributes = BASIC_ROW_ATTRIBUTES + attributes
+    return [
+        (attribute, attribute) if not isinstance(attribute, tuple) else attribute
+        for attribute in attributes
+    ]
+
+def get_attributes_for_geo_type(geo_type):
+    # Shapefile attributes a geo_type's rows are built from, or None if
+    # we don't know the geo_type
+    if geo_type not in ROW_SPECS:
+        return None
+    return [attribute for _, attribute in _get_attribute_pairs(geo_type)]
+
+def round_geometry(geom, precision):
+    # Returns a copy of geom with coordinates rounded to precision
+    # decimal places, by way of OGR's GeoJSON writer
+    return ogr.CreateGeometryFromJson(geom.ExportToJson(
+        ['COORDINATE_PRECISION=%d' % precision]))
+
+def format_geometry(geom, geom_format='wkt', precision=None):
+    if geom is None:
+        return None
+    if geom_format == 'geojson':
+        options = ['COORDINATE_PRECISION=%d' % precision] \
+            if precision is not None else []
+        return geom.ExportToJson(options)
+
+    if precision is not None:
+        geom = round_geometry(geom, precision)
+    if geom_format == 'wkt':
+        return str(geom)
+    wkb = geom.ExportToWkb(ogr.wkbNDR)
+    if geom_format == 'wkb':
+        return bytes(wkb)
+    if geom_format == 'wkb-hex':
+        return binascii.hexlify(wkb).decode('ascii').upper()
+    raise ValueError('Unknown geometry format: %s' % geom_format)
+
+class RowBuilder(object):
+    '''
+    Builds csv rows for the features of one layer. Field indexes and
+    output positions are looked up once, when the builder is made, so
+    each feature only costs a few GetField calls by index.
+
+        >> row_builder = RowBuilder(layer.GetLayerDefn(), 'county',
+                                    state_fips_dict=STATE_FIPS_DICT)
+        >> row = row_builder.build(feature)
+    '''
+    def __init__(self, layer_defn, geo_type, include_polygon=False,
+                 geometry_options=None, state_fips_dict=None):
+        if geo_type not in ROW_SPECS:
+            raise Exception('No row builder for geo type: %s' % geo_type)
+        spec = ROW_SPECS[geo_type]
+        geometry_options = geometry_options or {}
+        fields = get_fields_for_csv(
+            include_polygon=include_polygon,
+            simplify=geometry_options.get('simplify'))
+        position = dict((field, i) for i, field in enumerate(fields))
+
+        def get_field_index(attribute):
+            index = layer_defn.GetFieldIndex(attribute)
+            if index < 0:
+                raise KeyError('Missing %s attribute for geo type %s' % (
+                    attribute, geo_type))
+            return index
+
+        self.template = [None] * len(fields)
+        self.template[position['GEO_TYPE']] = geo_type
+        self.template[position['SUMLEV']] = spec['sumlev']
+        self.attributes = [
+            (position[field], get_field_index(attribute))
+            for field, attribute in _get_attribute_pairs(geo_type)
+        ]
+
+        self.state_fips_dict = state_fips_dict
+        self.statefp_index = None
+        if spec.get('basic', True):
+            self.statefp_index = get_field_index('STATEFP')
+            self.statefp_position = position['STATEFP']
+            self.state_dict_fields = [
+                (position[field], key) for field, key in STATE_DICT_FIELDS
+            ]
+
+        self.full_geoid_position = position['FULL_GEOID']
+        self.full_geoid = (
+            spec.get('full_geoid', spec['sumlev'] + '00US%s'),
+            position['GEOID'],
+        )
+        self.full_name_position = position['FULL_NAME']
+        template, name_fields = spec['full_name']
+        self.full_name = (template, [
+            None if field is STATE_NAME else position[field]
+            for field in name_fields
+        ])
+        self.geometry_position = position.get('GEOMETRY')
+        self.geom_format = geometry_options.get('format', 'wkt')
+        self.precision = geometry_options.get('precision')
+        # [position, tolerance, iterator over cached values or None]
+        self.simplify = [
+            [position[get_simplified_field(tolerance)], tolerance, None]
+            for tolerance in geometry_options.get('simplify') or []
+        ] if self.geometry_position is not None else []
+
+    def get_simplified_position(self, tolerance):
+        for position, _tolerance, _ in self.simplify:
+            if _tolerance == tolerance:
+                return position
+
+    def use_cached_geometry(self, tolerance, values):
+        # Take the geometry simplified to tolerance from values, one per
+        # row built, instead of simplifying it again
+        for simplified in self.simplify:
+            if simplified[1] == tolerance:
+                simplified[2] = iter(values)
+
+    def get_statefp(self, feature):
+        return feature.GetField(self.statefp_index)
+
+    def build(self, feature):
+        row = self.template[:]
+        for position, index in self.attributes:
+            row[position] = feature.GetField(index)
+
+        state_name = None
+        if self.statefp_index is not None:
+            state_dict = self.state_fips_dict[str(row[self.statefp_position])]
+            for position, key in self.state_dict_fields:
+                row[position] = state_dict[key]
+            state_name = state_dict['name']
 
-def _build_full_geoid(sumlev, item_options):
-    return '%s%sUS%s' % (sumlev, '00', item_options['geoid'])
-
-def make_cd_row(feature, item, item_options):
-    _sumlev = '500'
-    _namelsad = feature.GetField("NAMELSAD")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s %s' % (item_options['state_dict']['name'], _namelsad),
-        'SUMLEV': _sumlev,
-        'CD112FP': feature.GetField("CD112FP"),
-        'CDSESSN': feature.GetField("CDSESSN"),
-        'NAMELSAD': _namelsad,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_county_row(feature, item, item_options):
-    _sumlev = '050'
-    _namelsad = feature.GetField("NAMELSAD")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s, %s' % (_namelsad, item_options['state_dict']['name']),
-        'SUMLEV': _sumlev,
-        'COUNTYFP': feature.GetField("COUNTYFP"),
-        'CLASSFP': feature.GetField("CLASSFP"),
-        'CSAFP': feature.GetField("CSAFP"),
-        'CBSAFP': feature.GetField("CBSAFP"),
-        'METDIVFP': feature.GetField("METDIVFP"),
-        'NAME': feature.GetField("NAME"),
-        'NAMELSAD': _namelsad,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_elsd_row(feature, item, item_options):
-    _sumlev = '950'
-    _name = feature.GetField("NAME")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s, %s' % (_name, item_options['state_dict']['name']),
-        'SUMLEV': _sumlev,
-        'ELSDLEA': feature.GetField("ELSDLEA"),
-        'NAME': _name,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_scsd_row(feature, item, item_options):
-    _sumlev = '960'
-    _name = feature.GetField("NAME")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s, %s' % (_name, item_options['state_dict']['name']),
-        'SUMLEV': _sumlev,
-        'SCSDLEA': feature.GetField("SCSDLEA"),
-        'NAME': _name,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_unsd_row(feature, item, item_options):
-    _sumlev = '970'
-    _name = feature.GetField("NAME")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s, %s' % (_name, item_options['state_dict']['name']),
-        'SUMLEV': _sumlev,
-        'UNSDLEA': feature.GetField("UNSDLEA"),
-        'NAME': _name,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_sldu_row(feature, item, item_options):
-    _sumlev = '610'
-    _namelsad = feature.GetField("NAMELSAD")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s %s' % (item_options['state_dict']['name'], _namelsad),
-        'SUMLEV': _sumlev,
-        'SLDUST': feature.GetField("SLDUST"),
-        'NAMELSAD': _namelsad,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_sldl_row(feature, item, item_options):
-    _sumlev = '620'
-    _namelsad = feature.GetField("NAMELSAD")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s %s' % (item_options['state_dict']['name'], _namelsad),
-        'SUMLEV': _sumlev,
-        'SLDLST': feature.GetField("SLDLST"),
-        'NAMELSAD': _namelsad,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_place_row(feature, item, item_options):
-    _sumlev = '160'
-    _name = feature.GetField("NAME")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': '%s, %s' % (_name, item_options['state_dict']['name']),
-        'SUMLEV': _sumlev,
-        'PLACEFP': feature.GetField("PLACEFP"),
-        'CLASSFP': feature.GetField("CLASSFP"),
-        'PCICBSA': feature.GetField("PCICBSA"),
-        'PCINECTA': feature.GetField("PCINECTA"),
-        'NAME': feature.GetField("NAME"),
-        'NAMELSAD': feature.GetField("NAMELSAD"),
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_state_row(feature, item, item_options):
-    _sumlev = '040'
-    _name = feature.GetField("NAME")
-    item.update({
-        'FULL_GEOID': _build_full_geoid(_sumlev, item_options),
-        'FULL_NAME': _name,
-        'SUMLEV': _sumlev,
-        'NAME': _name,
-        'LSAD': feature.GetField("LSAD"),
-    })
-    return item
-
-def make_zcta5_row(feature, item, geo_type, item_options):
-    # Zip Code Tabulation Area shapefiles have attrs named differently
-    _sumlev = '860'
-    _geoid = feature.GetField("GEOID10")
-    _name = feature.GetField("ZCTA5CE10")
-    item.update({
-        'FULL_GEOID': '%s|%s' % (_sumlev, _geoid),
-        'FULL_NAME': 'ZIP Code: %s' % _name,
-        'SUMLEV': _sumlev,
-        'GEO_TYPE': geo_type,
-        'GEOID': _geoid,
-        'CLASSFP': feature.GetField("CLASSFP10"),
-        'ZCTA5CE10': _name,
-        'ALAND': feature.GetField("ALAND10"),
-        'INTPTLAT': feature.GetField("INTPTLAT10"),
-        'INTPTLON': feature.GetField("INTPTLON10"),
-    })
-    if item_options['include_polygon']:
-        _geom = feature.GetGeometryRef()
-        item.update({
-            'GEOMETRY': str(_geom),
-        })
-    return item
+        template, geoid_position = self.full_geoid
+        row[self.full_geoid_position] = template % row[geoid_position]
+        template, name_positions = self.full_name
+        row[self.full_name_position] = template % tuple(
+            state_name if position is None else row[position]
+            for position in name_positions
+        )
 
+        if self.geometry_position is not None:
+            geom = feature.GetGeometryRef()
+            if self.geom_format == 'wkt' and self.precision is None:
+                # Same as the csv has always had, even for missing geometry
+                row[self.geometry_position] = str(geom)
+            else:
+                row[self.geometry_position] = format_geometry(
+                    geom, self.geom_format, self.precision)
+            for position, tolerance, cached in self.simplify:
+                if cached is not None:
+                    row[position] = next(cached)
+                elif geom is not None:
+                    row[position] = format_geometry(
+                        geom.SimplifyPreserveTopology(tolerance),
+                        self.geom_format, self.precision)
+        return tuple(row)
@@ -0,0 +1,34 @@
+'''
+Helpers for the files parse_shapefiles.py and fetch_shapefiles.py keep
+between runs: the sidecar indexes, cache entries and manifest.
+'''
+
+import os
+
+VSIZIP_PREFIX = '/vsizip/'
+
+
+def split_vsizip_path(filename):
+    # Returns (zip filename, member) for an OGR /vsizip/ path, or
+    # (None, filename) for anything else
+    if not filename.startswith(VSIZIP_PREFIX):
+        return None, filename
+    zip_filename, member = filename[len(VSIZIP_PREFIX):].split('.zip/', 1)
+    return zip_filename + '.zip', member
+
+
+def replace_file(path, write, mode='w'):
+    # Calls write(f) on a temporary file, then moves it over path, so a
+    # crash never leaves a half-written file behind. The temporary name
+    # includes the process ID, since worker processes may write the same
+    # path at once. IOError and OSError are left to the caller.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, mode) as f:
+            write(f)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,155 @@
+'''
+Helpers for the FULL_GEOID index parse_shapefiles.py writes next to its csv
+with -i, and for looking up rows in the csv with it.
+
+The index is a small header, then one fixed-width record per csv row,
+sorted by FULL_GEOID: the FULL_GEOID, padded with null bytes to the width
+of the longest one, and the byte offset of the row in the csv, as a
+big-endian unsigned 64-bit integer. A GeoidIndex memory-maps the index and
+the csv, and binary-searches the records, so opening one costs nothing
+however large the csv is, and each lookup only reads the pages it needs.
+
+    >> index = GeoidIndex('generated_csv/all_geographies.csv')
+    >> index.get('05000US53063')['FULL_NAME']
+    'Spokane County, Washington'
+'''
+
+import csv
+import mmap
+import struct
+
+INDEX_SUFFIX = '.idx'
+
+MAGIC = b'FULLGEOID-IDX-01'
+# Magic, key width, record count
+HEADER = struct.Struct('>16sHQ')
+OFFSET = struct.Struct('>Q')
+
+
+def get_index_path(csv_path):
+    return csv_path + INDEX_SUFFIX
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+class OffsetTracker(object):
+    '''
+    Stands in for a text file being written by a csv.writer, counting the
+    bytes written so the offset of the next row is always known.
+    '''
+    def __init__(self, f):
+        self.f = f
+        self.encoding = getattr(f, 'encoding', None) or 'utf-8'
+        self.offset = 0
+
+    def write(self, value):
+        self.f.write(value)
+        # Python 2's str is already bytes
+        self.offset += len(value) if isinstance(value, bytes) \
+            else len(value.encode(self.encoding))
+
+
+def write_index(path, entries):
+    # entries is a sequence of (FULL_GEOID, byte offset) pairs, in any order
+    entries = sorted((_to_bytes(key), offset) for key, offset in entries)
+    key_width = max([len(key) for key, _ in entries] or [0])
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, key_width, len(entries)))
+        for key, offset in entries:
+            f.write(key.ljust(key_width, b'\0'))
+            f.write(OFFSET.pack(offset))
+
+
+def _map_file(f):
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class GeoidIndex(object):
+    '''
+    Looks up rows of a csv written by parse_shapefiles.py by FULL_GEOID,
+    through the index written with it.
+    '''
+    def __init__(self, csv_path, index_path=None):
+        index_path = index_path or get_index_path(csv_path)
+        self.index_file = open(index_path, 'rb')
+        self.index = _map_file(self.index_file)
+        magic, self.key_width, self.count = HEADER.unpack_from(self.index, 0)
+        if magic != MAGIC:
+            self.close()
+            raise Exception('Not a FULL_GEOID index: %s' % index_path)
+        self.record_size = self.key_width + OFFSET.size
+
+        self.csv_file = open(csv_path, 'rb')
+        self.csv = _map_file(self.csv_file)
+        self.fields = self.read_row(0)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, full_geoid):
+        return bool(self.find(full_geoid))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for name in ('csv', 'csv_file', 'index', 'index_file'):
+            if getattr(self, name, None) is not None:
+                getattr(self, name).close()
+                setattr(self, name, None)
+
+    def _get_key(self, i):
+        start = HEADER.size + i * self.record_size
+        return self.index[start:start + self.key_width]
+
+    def _get_offset(self, i):
+        start = HEADER.size + i * self.record_size + self.key_width
+        return OFFSET.unpack_from(self.index, start)[0]
+
+    def find(self, full_geoid):
+        # Byte offsets of the rows with this FULL_GEOID, in csv order
+        key = _to_bytes(full_geoid)
+        if len(key) > self.key_width:
+            return []
+        key = key.ljust(self.key_width, b'\0')
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        offsets = []
+        while low < self.count and self._get_key(low) == key:
+            offsets.append(self._get_offset(low))
+            low += 1
+        return offsets
+
+    def read_row(self, offset):
+        # Rows never span lines; geometry and names have no newlines
+        end = self.csv.find(b'\n', offset)
+        line = self.csv[offset:end if end >= 0 else len(self.csv)]
+        if bytes is not str:
+            line = line.decode('utf-8')
+        return next(csv.reader([line]))
+
+    def get_rows(self, full_geoid):
+        return [
+            dict(zip(self.fields, self.read_row(offset)))
+            for offset in self.find(full_geoid)
+        ]
+
+    def get(self, full_geoid, default=None):
+        # The row with this FULL_GEOID as a dict of csv fields, or default
+        offsets = self.find(full_geoid)
+        if not offsets:
+            return default
+        return dict(zip(self.fields, self.read_row(offsets[0])))
@@ -0,0 +1,132 @@
+'''
+Helpers for writing parse_shapefiles.py output straight into a GeoPackage
+or SpatiaLite database, through OGR's GPKG and SQLite drivers.
+
+Rows are inserted inside transactions of TRANSACTION_SIZE features, with
+no indexes in place. Once every row is loaded, the spatial index and
+B-tree indexes on INDEX_FIELDS are built in one go, which is much quicker
+than keeping them up to date through the load.
+'''
+
+import binascii
+import os
+
+from osgeo import ogr, osr
+
+from helpers.csv_helpers import FLOAT_FIELDS, INTEGER_FIELDS, to_float, to_int
+
+# Output format: (OGR driver, dataset creation options, layer creation options)
+DATABASE_FORMATS = {
+    'gpkg': ('GPKG', [], ['GEOMETRY_NAME=GEOMETRY', 'SPATIAL_INDEX=NO']),
+    'sqlite': ('SQLite', ['SPATIALITE=YES'],
+               ['GEOMETRY_NAME=GEOMETRY', 'SPATIAL_INDEX=NO', 'LAUNDER=NO']),
+}
+
+TRANSACTION_SIZE = 100000
+
+INDEX_FIELDS = ['FULL_GEOID', 'SUMLEV', 'STATEFP',]
+
+# TIGER/Line shapefiles are in NAD83
+SOURCE_EPSG = 4269
+
+
+def _get_field_type(field):
+    if field in INTEGER_FIELDS:
+        # GDAL 1.x has no 64-bit integer fields, and ALAND can overflow 32
+        return getattr(ogr, 'OFTInteger64', ogr.OFTReal)
+    if field in FLOAT_FIELDS:
+        return ogr.OFTReal
+    if field.startswith('GEOMETRY_'):
+        # Simplified geometries, as WKB
+        return ogr.OFTBinary
+    return ogr.OFTString
+
+
+def _get_converter(field):
+    if field in INTEGER_FIELDS:
+        return to_int
+    if field in FLOAT_FIELDS:
+        return to_float
+    return None
+
+
+def _execute_sql(dataset, sql):
+    result = dataset.ExecuteSQL(sql)
+    if result is not None:
+        dataset.ReleaseResultSet(result)
+
+
+def write_database(path, rows, fields, output_format='gpkg', layer_name=None,
+                   transaction_size=TRANSACTION_SIZE):
+    # rows are sequences of values in fields order, with geometries as WKB
+    driver_name, dataset_options, layer_options = \
+        DATABASE_FORMATS[output_format]
+    driver = ogr.GetDriverByName(driver_name)
+    if driver is None:
+        raise Exception('GDAL was built without the %s driver' % driver_name)
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+
+    layer_name = layer_name or os.path.splitext(os.path.basename(path))[0]
+    dataset = driver.CreateDataSource(path, options=dataset_options)
+    geometry_position = fields.index('GEOMETRY') \
+        if 'GEOMETRY' in fields else None
+    if geometry_position is not None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(SOURCE_EPSG)
+        layer = dataset.CreateLayer(
+            layer_name, srs, ogr.wkbUnknown, options=layer_options)
+    else:
+        layer = dataset.CreateLayer(
+            layer_name, None, ogr.wkbNone, options=layer_options)
+
+    for field in fields:
+        if field != 'GEOMETRY':
+            layer.CreateField(ogr.FieldDefn(field, _get_field_type(field)))
+    layer_defn = layer.GetLayerDefn()
+    # (row position, field index, converter, binary?) for each attribute
+    columns = [
+        (position, layer_defn.GetFieldIndex(field), _get_converter(field),
+         _get_field_type(field) == ogr.OFTBinary)
+        for position, field in enumerate(fields)
+        if field != 'GEOMETRY'
+    ]
+
+    try:
+        count = 0
+        layer.StartTransaction()
+        for row in rows:
+            feature = ogr.Feature(layer_defn)
+            for position, index, converter, binary in columns:
+                value = row[position]
+                if value is None:
+                    continue
+                if binary:
+                    feature.SetFieldBinaryFromHexString(
+                        index, binascii.hexlify(value).decode('ascii'))
+                else:
+                    feature.SetField(
+                        index, converter(value) if converter else value)
+            if geometry_position is not None and \
+                    row[geometry_position] is not None:
+                feature.SetGeometryDirectly(
+                    ogr.CreateGeometryFromWkb(row[geometry_position]))
+            layer.CreateFeature(feature)
+            feature.Destroy()
+
+            count += 1
+            if count % transaction_size == 0:
+                layer.CommitTransaction()
+                layer.StartTransaction()
+        layer.CommitTransaction()
+
+        # Build the indexes now that the data is all in place
+        if geometry_position is not None:
+            _execute_sql(dataset, "SELECT CreateSpatialIndex('%s', '%s')" % (
+                layer_name, 'GEOMETRY'))
+        for field in INDEX_FIELDS:
+            if field in fields:
+                _execute_sql(dataset, 'CREATE INDEX "%s_%s_idx" ON "%s" ("%s")'
+                             % (layer_name, field.lower(), layer_name, field))
+    finally:
+        dataset.Destroy()
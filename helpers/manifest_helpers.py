@@ -0,0 +1,123 @@
+'''
+Helpers for tracking remote directory listings and downloaded files
+in fetch_shapefiles.py
+'''
+
+import json
+import os
+import threading
+import time
+
+from helpers.file_helpers import replace_file
+
+
+class Manifest(object):
+    '''
+    JSON record of each remote directory listing and of the remote size
+    and modification time of every file downloaded from it. Listings
+    younger than ttl seconds are reused instead of asking the server
+    again, and a local file is only fetched again when the size in the
+    latest listing differs from what it was downloaded as, or the date,
+    where the server gives one (HTTP's Last-Modified, FTP's MDTM).
+    '''
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = {'listings': {}, 'files': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data.update(json.load(f))
+
+    def get_listing(self, target):
+        # Returns the cached entries for target, or None if missing/expired
+        listing = self.data['listings'].get(target)
+        if listing and time.time() - listing['fetched'] < self.ttl:
+            return listing['entries']
+        return None
+
+    def set_listing(self, target, entries):
+        with self.lock:
+            self.data['listings'][target] = {
+                'fetched': time.time(),
+                'entries': entries,
+            }
+
+    def get_remote_entry(self, file_location):
+        target, name = file_location.rsplit('/', 1)
+        listing = self.data['listings'].get(target + '/')
+        if listing:
+            for entry in listing['entries']:
+                if entry['name'] == name:
+                    return entry
+        return None
+
+    def needs_stat(self, file_location):
+        # Whether to ask the server for a file's size and date: the
+        # listing is missing one of them, and hasn't been filled in by
+        # update_remote_entry since it was fetched
+        entry = self.get_remote_entry(file_location)
+        if entry is None:
+            return True
+        return not entry.get('checked') and (
+            entry['size'] is None or entry['modified'] is None)
+
+    def update_remote_entry(self, file_location, values):
+        # Fill in details the listing didn't have, like the size and date
+        # from an HTTP HEAD or FTP MDTM request, so later runs can reuse
+        # them
+        entry = self.get_remote_entry(file_location)
+        if entry is not None:
+            with self.lock:
+                entry.update(values)
+                entry['checked'] = True
+
+    def is_stale(self, file_location, filename):
+        remote = self.get_remote_entry(file_location)
+        if not remote or remote['size'] is None:
+            # Nothing to compare against, trust the local file
+            return False
+
+        local = self.data['files'].get(os.path.basename(filename))
+        if local is None:
+            # Downloaded before the manifest existed. Adopt the file if it
+            # at least matches the remote size.
+            if os.path.getsize(filename) != remote['size']:
+                return True
+            self.record_download(file_location, filename)
+            return False
+
+        if local['size'] != remote['size']:
+            return True
+        if local['modified'] is None and remote['modified'] is not None:
+            # Recorded before the server's date was known. The size still
+            # matches, so take the date from now on.
+            with self.lock:
+                local['modified'] = remote['modified']
+            return False
+        # Only compare dates when both sides have one
+        return (local['modified'] is not None and
+                remote['modified'] is not None and
+                local['modified'] != remote['modified'])
+
+    def record_download(self, file_location, filename):
+        remote = self.get_remote_entry(file_location) or {}
+        with self.lock:
+            self.data['files'][os.path.basename(filename)] = {
+                'url': file_location,
+                'size': remote.get('size') or os.path.getsize(filename),
+                'modified': remote.get('modified'),
+            }
+
+    def get_throughput(self):
+        # Bytes per second measured during the last download session
+        return self.data.get('throughput')
+
+    def record_throughput(self, bytes_per_second):
+        with self.lock:
+            self.data['throughput'] = bytes_per_second
+
+    def save(self):
+        with self.lock:
+            replace_file(self.path, lambda f: json.dump(
+                self.data, f, indent=1, sort_keys=True))
@@ -0,0 +1,45 @@
+'''
+Helpers for sharing work out between a pool of worker processes in
+parse_shapefiles.py, reverse_geocode.py and build_hierarchy.py.
+
+    >> for result in map_ordered(parse, tasks, jobs=4):
+    >>     write(result)
+'''
+
+import multiprocessing
+from collections import deque
+
+
+def map_ordered(func, items, jobs, initializer=None, initargs=(),
+                max_pending=None):
+    # Yields func(item) for each item, in order. With one job, or a single
+    # item, everything runs in this process. With max_pending, at most that
+    # many items are handed to the pool at once, so a long iterator of
+    # items isn't read into memory faster than the workers get through it.
+    if max_pending is None:
+        items = list(items)
+        jobs = min(jobs, len(items))
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = multiprocessing.Pool(jobs, initializer, initargs)
+    try:
+        if max_pending is None:
+            for result in pool.imap(func, items):
+                yield result
+        else:
+            pending = deque()
+            for item in items:
+                pending.append(pool.apply_async(func, (item,)))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
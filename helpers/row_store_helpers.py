@@ -0,0 +1,189 @@
+'''
+Compact in-memory storage for the rows parse_shapefiles.py sorts before
+writing its csv.
+
+Rows are stored by column rather than as one tuple per row. Columns with
+only a few distinct values, like GEO_TYPE, REGION_NAME or STATEFP, are
+dictionary-encoded: each distinct value is kept once, and every row stores
+a small integer code for it in an array. Fields that don't apply to a geo
+type cost two bytes per row instead of a pointer to None. Mostly unique
+text, like FULL_GEOID or NAME, is packed end to end in one buffer instead
+of being kept as separate string objects.
+
+    >> store = RowStore(csv_helpers.get_fields_for_csv())
+    >> store.extend(rows)
+    >> for row in store.iter_sorted():
+    >>     csvwriter.writerow(row)
+'''
+
+from array import array
+
+try:
+    array('q')
+    OFFSET_TYPECODE = 'q'
+except ValueError:
+    # Python 2's array has no 'q' type
+    OFFSET_TYPECODE = 'l'
+
+# Fields with few enough distinct values to be worth dictionary-encoding
+CATEGORICAL_FIELDS = [
+    'SUMLEV',
+    'GEO_TYPE',
+    'REGION',
+    'REGION_NAME',
+    'DIVISION',
+    'DIVISION_NAME',
+    'STATEFP',
+    'CD112FP',
+    'CDSESSN',
+    'COUNTYFP',
+    'CLASSFP',
+    'SLDLST',
+    'SLDUST',
+    'PCICBSA',
+    'PCINECTA',
+    'CSAFP',
+    'CBSAFP',
+    'METDIVFP',
+    'LSAD',
+]
+
+# Mostly unique text fields, packed into a TextColumn. Any other field is
+# kept in a plain list.
+TEXT_FIELDS = [
+    'FULL_GEOID',
+    'FULL_NAME',
+    'GEOID',
+    'PLACEFP',
+    'ELSDLEA',
+    'SCSDLEA',
+    'UNSDLEA',
+    'ZCTA5CE10',
+    'NAME',
+    'NAMELSAD',
+    'INTPTLAT',
+    'INTPTLON',
+    'GEOMETRY',
+]
+
+# Geometry columns, including the GEOMETRY_<tolerance> columns added for
+# each simplification tolerance, are always packed as text or WKB
+GEOMETRY_FIELD_PREFIX = 'GEOMETRY'
+
+
+class CategoricalColumn(object):
+    '''
+    A column of dictionary-encoded values. Codes start out as unsigned
+    shorts, and are widened if a column ever has more than 65536
+    distinct values.
+    '''
+    def __init__(self):
+        self.values = []
+        self.codes_by_value = {}
+        self.codes = array('H')
+
+    def append(self, value):
+        code = self.codes_by_value.get(value)
+        if code is None:
+            code = len(self.values)
+            if code == 1 << 16:
+                self.codes = array('I', self.codes)
+            self.values.append(value)
+            self.codes_by_value[value] = code
+        self.codes.append(code)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+
+class TextColumn(object):
+    '''
+    A column of strings stored as UTF-8 bytes, or of bytes values like WKB,
+    end to end in one buffer, with an array of where each value ends. The
+    first value decides which of the two the column holds. Anything else,
+    including None, is flagged with a negative end and kept as it is.
+    '''
+    def __init__(self):
+        self.buffer = bytearray()
+        self.ends = array(OFFSET_TYPECODE)
+        self.other = {}
+        self.binary = None
+
+    def append(self, value):
+        if isinstance(value, (str, bytes)):
+            # Python 2's str is already bytes, and is packed as it is
+            binary = bytes is not str and isinstance(value, bytes)
+            if self.binary is None:
+                self.binary = binary
+            if binary == self.binary:
+                try:
+                    self.buffer.extend(
+                        value if binary or bytes is str
+                        else value.encode('utf-8'))
+                    self.ends.append(len(self.buffer))
+                    return
+                except UnicodeEncodeError:
+                    pass
+        if value is not None:
+            self.other[len(self.ends)] = value
+        self.ends.append(-len(self.buffer) - 1)
+
+    def __getitem__(self, i):
+        end = self.ends[i]
+        if end < 0:
+            return self.other.get(i)
+        start = self.ends[i - 1] if i else 0
+        if start < 0:
+            start = -start - 1
+        value = bytes(self.buffer[start:end])
+        return value if self.binary or bytes is str else value.decode('utf-8')
+
+
+def _make_column(field, categorical_fields, text_fields):
+    if field in categorical_fields:
+        return CategoricalColumn()
+    if field in text_fields or field.startswith(GEOMETRY_FIELD_PREFIX):
+        return TextColumn()
+    return []
+
+
+class RowStore(object):
+    '''
+    Holds rows of values in fields order, and gives them back as tuples,
+    in insertion order or sorted on one field.
+    '''
+    def __init__(self, fields, categorical_fields=CATEGORICAL_FIELDS,
+                 text_fields=TEXT_FIELDS):
+        self.fields = fields
+        self.columns = [
+            _make_column(field, categorical_fields, text_fields)
+            for field in fields
+        ]
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, row):
+        for column, value in zip(self.columns, row):
+            column.append(value)
+        self.length += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def get_row(self, i):
+        return tuple(column[i] for column in self.columns)
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.get_row(i)
+
+    def iter_sorted(self, field_index=0):
+        # Sorts a permutation of row numbers rather than the rows. The sort
+        # is stable, so rows with equal keys keep their insertion order.
+        column = self.columns[field_index]
+        order = sorted(range(self.length), key=column.__getitem__)
+        for i in order:
+            yield self.get_row(i)
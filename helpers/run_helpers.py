@@ -0,0 +1,78 @@
+'''
+Helpers for sorting parsed rows on disk in parse_shapefiles.py
+
+Rows are lists of csv values with FULL_GEOID first. They are written
+out in sorted "run" files, then merged back together in FULL_GEOID
+order, so only one row per run needs to be held in memory.
+'''
+
+import heapq
+import marshal
+import os
+import tempfile
+from operator import itemgetter
+
+# Runs are merged at most MERGE_FANIN at a time, to stay well under
+# the limit on open files
+MERGE_FANIN = 128
+
+# str and bytes on Python 3; str and unicode on Python 2
+TEXT_TYPES = (bytes, type(u''))
+
+
+def get_row_size(row):
+    # Rough number of bytes a row holds: the length of each text value,
+    # and 8 for anything else
+    return sum(
+        len(value) if isinstance(value, TEXT_TYPES) else 8 for value in row)
+
+
+def write_run(run_dir, rows, presorted=False):
+    if not presorted:
+        # list.sort is stable, so rows with the same FULL_GEOID keep
+        # the order they were read in
+        rows.sort(key=itemgetter(0))
+    fd, path = tempfile.mkstemp(suffix='.run', dir=run_dir)
+    with os.fdopen(fd, 'wb') as f:
+        for row in rows:
+            marshal.dump(row, f)
+    return path
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield marshal.load(f)
+            except EOFError:
+                return
+
+
+def _iter_keyed_run(run_index, path):
+    for position, row in enumerate(read_run(path)):
+        yield (row[0], run_index, position, row)
+
+
+def _merge(paths):
+    # Ties on FULL_GEOID fall back to run order, then to the order within
+    # the run, which gives the same result as one stable sort of all rows
+    runs = [_iter_keyed_run(run_index, path)
+            for run_index, path in enumerate(paths)]
+    for _, _, _, row in heapq.merge(*runs):
+        yield row
+
+
+def merge_runs(paths, run_dir, fanin=MERGE_FANIN, keep=()):
+    # Runs are removed once merged into a longer one, except those in keep
+    while len(paths) > fanin:
+        # Merge consecutive groups of runs into longer runs first
+        merged_paths = []
+        for i in range(0, len(paths), fanin):
+            group = paths[i:i + fanin]
+            merged_paths.append(write_run(run_dir, _merge(group), True))
+            for path in group:
+                if path not in keep:
+                    os.remove(path)
+        paths = merged_paths
+
+    return _merge(paths)
@@ -0,0 +1,119 @@
+'''
+Helpers for spatial lookups against the parsed geographies, used by
+reverse_geocode.py and build_hierarchy.py. Needs shapely 2:
+
+    >> pip install shapely
+
+A PolygonIndex converts a set of OGR geometries to shapely, prepares them,
+and builds an STRtree of their bounding boxes, all in GEOS. Lookups take a
+whole batch of points at once: the tree narrows each point down to the few
+polygons whose boxes contain it, and the prepared polygons test them
+exactly, without going back into Python for each point.
+
+    >> index = PolygonIndex(polygons)
+    >> index.lookup_batch([-122.3321, -117.4260], [47.6062, 47.6588])
+    [['16000US5363000'], ['16000US5367000']]
+
+Scripts load an index for each geography type with load_polygon_indexes,
+and keep them with set_indexes before starting a pool of workers, which
+find them with get_indexes. Forked workers share the parent's indexes;
+pass init_worker as the pool's initializer so spawned ones load their own.
+'''
+
+try:
+    import numpy
+    import shapely
+    from shapely import STRtree  # only at the top level from shapely 2
+except ImportError:
+    shapely = None
+
+from parse_shapefiles import iter_polygons, iter_shapefiles
+
+# [(geo_type, PolygonIndex)], loaded before any worker processes start
+_INDEXES = None
+
+
+class PolygonIndex(object):
+    '''
+    Prepared shapely geometries and their ids, behind an STRtree of their
+    bounding boxes. Positions returned by queries are positions in the
+    sequence the index was built from.
+    '''
+    def __init__(self, polygons):
+        # polygons is a sequence of (id, OGR geometry) pairs
+        self.ids = []
+        geometries = []
+        for _id, geometry in polygons:
+            self.ids.append(_id)
+            geometries.append(bytes(geometry.ExportToWkb()))
+        self.geometries = shapely.from_wkb(geometries)
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, geometries, predicate=None):
+        # Returns (input positions, index positions) arrays for each pair
+        # whose boxes overlap, or that match predicate ('intersects',
+        # 'within', ...), sorted by input position then index position
+        if isinstance(geometries, shapely.Geometry):
+            geometries = [geometries]
+        positions, matches = self.tree.query(geometries, predicate=predicate)
+        order = numpy.lexsort((matches, positions))
+        return positions[order], matches[order]
+
+    def lookup_points(self, points):
+        # Returns {position: ids} for each of an array of shapely points
+        # inside any of the geometries, with ids in index order. Build the
+        # points once to look them up in several indexes.
+        positions, matches = self.query(points, predicate='within')
+        ids = self.ids
+        results = {}
+        for position, match in zip(positions.tolist(), matches.tolist()):
+            if position in results:
+                results[position].append(ids[match])
+            else:
+                results[position] = [ids[match]]
+        return results
+
+    def lookup_batch(self, xs, ys):
+        # ids of the geometries containing each point, in index order
+        results = self.lookup_points(shapely.points(xs, ys))
+        return [results.get(i, []) for i in range(len(xs))]
+
+    def lookup(self, x, y):
+        return self.lookup_batch([x], [y])[0]
+
+
+def load_polygon_indexes(state=None, geo_types=None, from_zip=False):
+    # Returns a (geo_type, PolygonIndex) pair for each geography type with
+    # shapefiles, sorted by geo_type
+    polygons = {}
+    for _shapefile, _geo_type in iter_shapefiles(
+            state=state, geo_types=geo_types, from_zip=from_zip):
+        print("Loading: " + _shapefile + " ...")
+        polygons.setdefault(_geo_type, []).extend(
+            iter_polygons(_shapefile, state=state, geo_type=_geo_type))
+
+    return [
+        (_geo_type, PolygonIndex(polygons[_geo_type]))
+        for _geo_type in sorted(polygons)
+    ]
+
+
+def set_indexes(indexes):
+    global _INDEXES
+    _INDEXES = indexes
+
+
+def get_indexes():
+    return _INDEXES
+
+
+def init_worker(state=None, geo_types=None, from_zip=False):
+    # Forked workers already have the parent's indexes. Anywhere processes
+    # are spawned instead, each worker has to load its own.
+    if _INDEXES is None:
+        set_indexes(load_polygon_indexes(
+            state=state, geo_types=geo_types, from_zip=from_zip))
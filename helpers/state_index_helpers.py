@@ -0,0 +1,110 @@
+'''
+Helpers for the STATEFP sidecar indexes that parse_shapefiles.py keeps for
+national shapefiles, so single-state runs only read the features they need.
+
+An index maps each STATEFP to the ranges of feature IDs holding that state's
+features. It is written next to the shapefile (or next to the zip file, when
+reading through /vsizip/), and rebuilt whenever the size or modification
+time of the file it was built from changes.
+
+    >> get_state_ranges(filename, layer, '53')
+    [[2937, 2976]]
+'''
+
+import json
+import os
+
+from helpers.file_helpers import replace_file, split_vsizip_path
+
+INDEX_SUFFIX = '.statefp.json'
+
+
+def _get_paths(filename):
+    # Returns the sidecar path, and the file whose size and mtime it tracks:
+    # the zip for /vsizip/ paths, otherwise the .dbf holding STATEFP
+    zip_filename, _ = split_vsizip_path(filename)
+    if zip_filename:
+        return zip_filename[:-len('.zip')] + INDEX_SUFFIX, zip_filename
+    stem = os.path.splitext(filename)[0]
+    return stem + INDEX_SUFFIX, stem + '.dbf'
+
+
+def _get_source_key(source):
+    stat = os.stat(source)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def load_state_index(filename):
+    # Returns the saved index for filename, or None if missing or stale
+    index_path, source = _get_paths(filename)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except ValueError:
+        return None
+    if (index.get('shapefile') != os.path.basename(filename) or
+            index.get('source') != _get_source_key(source)):
+        return None
+    return index['ranges']
+
+
+def build_state_index(layer):
+    # Read only the STATEFP column, collapsing runs of consecutive feature
+    # IDs from the same state into [start, stop) ranges
+    layer_defn = layer.GetLayerDefn()
+    field_names = [
+        layer_defn.GetFieldDefn(i).GetName()
+        for i in range(layer_defn.GetFieldCount())
+    ]
+    layer.SetIgnoredFields(['OGR_GEOMETRY'] + [
+        name for name in field_names if name != 'STATEFP'
+    ])
+    ranges = {}
+    feature = layer.GetNextFeature()
+    while feature:
+        fid = feature.GetFID()
+        statefp = feature.GetField('STATEFP')
+        state_ranges = ranges.setdefault(statefp, [])
+        if state_ranges and state_ranges[-1][1] == fid:
+            state_ranges[-1][1] = fid + 1
+        else:
+            state_ranges.append([fid, fid + 1])
+        feature.Destroy()
+        feature = layer.GetNextFeature()
+
+    layer.SetIgnoredFields([])
+    layer.ResetReading()
+    return ranges
+
+
+def save_state_index(filename, ranges):
+    index_path, source = _get_paths(filename)
+    index = {
+        'shapefile': os.path.basename(filename),
+        'source': _get_source_key(source),
+        'ranges': ranges,
+    }
+    # The index is only an optimization, so carry on without it if the
+    # directory isn't writable
+    try:
+        replace_file(
+            index_path, lambda f: json.dump(index, f, sort_keys=True))
+    except (IOError, OSError):
+        print("Could not save state index: " + index_path)
+
+
+def get_state_ranges(filename, layer, statefp):
+    # Returns the [start, stop) feature ID ranges for statefp, building
+    # and saving the index first if needed. Returns None when there is no
+    # saved index and it couldn't be saved either, e.g. in a read-only
+    # DOWNLOAD_DIR, rather than scan the whole layer again on every run.
+    ranges = load_state_index(filename)
+    if ranges is None:
+        index_path, _ = _get_paths(filename)
+        if not os.access(os.path.dirname(index_path) or '.', os.W_OK):
+            return None
+        ranges = build_state_index(layer)
+        save_state_index(filename, ranges)
+    return ranges.get(statefp, [])
@@ -0,0 +1,409 @@
+'''
+Transports used by fetch_shapefiles.py to list remote directories and
+download files. Each transport keeps a pool of open connections that worker
+threads take turns using, so fetching hundreds of small files doesn't pay
+for a new handshake every time, and no host gets more than per_host
+connections at once.
+
+    >> transport = get_transport('ftp://ftp2.census.gov/geo/tiger/TIGER2012/')
+    >> entries = transport.list_directory(target)
+    >> stat = transport.stat(file_location)  # {'size': ..., 'modified': ...}
+    >> response, file_size, offset = transport.open(file_location, offset)
+'''
+
+import ftplib
+import io
+import os
+import re
+import sys
+import threading
+
+try:
+    from six.moves import http_client as httplib
+    from six.moves.urllib.parse import urljoin, urlparse
+    from six.moves.urllib.request import url2pathname
+except ImportError:
+    import httplib
+    from urlparse import urljoin, urlparse
+    from urllib import url2pathname
+
+
+def parse_listing_line(line):
+    # FTP LIST lines look like:
+    # -rw-rw-r--   1 ftp ftp   1234567 Nov 13  2012 tl_2012_01_place.zip
+    # The date switches to 'Nov 13 14:22' for files from the last six
+    # months, so it isn't a stable way to tell whether a file changed.
+    # Only the size is kept; FTPTransport.stat gets the date with MDTM.
+    parts = line.split()
+    entry = {
+        'name': parts[-1],
+        'size': None,
+        'modified': None,
+    }
+    if len(parts) >= 9 and parts[4].isdigit():
+        entry['size'] = int(parts[4])
+    return entry
+
+
+class ConnectionPool(object):
+    '''
+    Open connections shared between threads, at most limit at a time for
+    each host. acquire() hands out an idle connection, or opens a new one,
+    waiting while the host is at its limit. Give it back with release() to
+    reuse it, or discard() if it is broken.
+    '''
+    def __init__(self, connect, disconnect, limit=None):
+        self.connect = connect
+        self.disconnect = disconnect
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.semaphores = {}
+
+    def _get_semaphore(self, key):
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(
+                    self.limit) if self.limit else None
+            return self.semaphores[key]
+
+    def _release_slot(self, key):
+        semaphore = self._get_semaphore(key)
+        if semaphore:
+            semaphore.release()
+
+    def acquire(self, key):
+        semaphore = self._get_semaphore(key)
+        if semaphore:
+            semaphore.acquire()
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop()
+        try:
+            return self.connect(*key)
+        except:
+            self._release_slot(key)
+            raise
+
+    def release(self, key, connection):
+        with self.lock:
+            self.idle.setdefault(key, []).append(connection)
+        self._release_slot(key)
+
+    def discard(self, key, connection):
+        self._release_slot(key)
+        self.disconnect(connection)
+
+    def close(self):
+        # Connections still handed out are closed by their users
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                self.disconnect(connection)
+
+
+class FTPResponse(object):
+    '''
+    File-like wrapper around an ftplib data connection. Closing it finishes
+    the transfer and gives the control connection back to the pool for the
+    next file.
+    '''
+    def __init__(self, transport, key, ftp, conn):
+        self.transport = transport
+        self.key = key
+        self.ftp = ftp
+        self.conn = conn
+        self.fp = conn.makefile('rb')
+        self.closed = False
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def readinto(self, b):
+        return self.fp.readinto(b)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.fp.close()
+        self.conn.close()
+        try:
+            self.ftp.voidresp()
+        except ftplib.all_errors:
+            self.transport.pool.discard(self.key, self.ftp)
+        else:
+            self.transport.pool.release(self.key, self.ftp)
+
+
+class FTPTransport(object):
+    def __init__(self, timeout, per_host=None):
+        self.timeout = timeout
+        self.pool = ConnectionPool(
+            self._connect, self._disconnect, limit=per_host)
+
+    def _connect(self, host, port, username, password):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(host, port)
+        ftp.login(username, password)
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def _disconnect(self, ftp):
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+    def _get_key(self, location):
+        return (location.hostname, location.port or ftplib.FTP_PORT,
+                location.username or 'anonymous', location.password or '')
+
+    def _call(self, url, command, hold=False):
+        # Run command(key, ftp, path) on a pooled session, reconnecting
+        # once if the server has dropped an idle control connection. With
+        # hold, the session stays checked out, for what command returns to
+        # give back.
+        location = urlparse(url)
+        key = self._get_key(location)
+        for attempt in range(2):
+            ftp = self.pool.acquire(key)
+            try:
+                result = command(key, ftp, location.path)
+            except (EOFError,) + ftplib.all_errors:
+                self.pool.discard(key, ftp)
+                if attempt:
+                    raise
+                continue
+            except:
+                self.pool.discard(key, ftp)
+                raise
+            if not hold:
+                self.pool.release(key, ftp)
+            return result
+
+    def list_directory(self, url):
+        def command(key, ftp, path):
+            lines = []
+            ftp.retrlines('LIST %s' % path, lines.append)
+            return lines
+        return [parse_listing_line(line) for line in self._call(url, command)]
+
+    def stat(self, url):
+        # MDTM gives the modification time as YYYYMMDDHHMMSS in UTC, unlike
+        # the dates in LIST lines (see parse_listing_line). Servers without
+        # it leave modified empty, and files are only compared by size.
+        def command(key, ftp, path):
+            size = ftp.size(path)
+            try:
+                modified = ftp.sendcmd('MDTM ' + path).split()[1]
+            except ftplib.error_perm:
+                modified = None
+            return {'size': size, 'modified': modified}
+        return self._call(url, command)
+
+    def open(self, url, offset=0):
+        def command(key, ftp, path):
+            file_size = ftp.size(path)
+            conn = ftp.transfercmd('RETR %s' % path, rest=offset or None)
+            return FTPResponse(self, key, ftp, conn), file_size, offset
+        return self._call(url, command, hold=True)
+
+    def close(self):
+        self.pool.close()
+
+
+class HTTPResponse(object):
+    '''
+    File-like wrapper around an httplib response. Closing it after the
+    whole body has been read gives the connection back to the pool.
+    '''
+    def __init__(self, transport, key, conn, response):
+        self.transport = transport
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.closed = False
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.response.read()
+        return self.response.read(size)
+
+    def readinto(self, b):
+        if hasattr(self.response, 'readinto'):
+            return self.response.readinto(b)
+        # Python 2's httplib has no readinto
+        data = self.response.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.response.isclosed():
+            self.transport.pool.release(self.key, self.conn)
+        else:
+            # Unread data would corrupt the next response on this connection
+            self.response.close()
+            self.transport.pool.discard(self.key, self.conn)
+
+
+class HTTPTransport(object):
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout, per_host=None):
+        self.timeout = timeout
+        self.pool = ConnectionPool(
+            self._connect, self._disconnect, limit=per_host)
+
+    def _connect(self, scheme, host, port):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _disconnect(self, conn):
+        conn.close()
+
+    def _send(self, key, method, path, headers):
+        # Returns a pooled connection and its response, retrying once on a
+        # fresh connection if a kept-alive one was closed by the server
+        for attempt in range(2):
+            conn = self.pool.acquire(key)
+            try:
+                conn.request(method, path, headers=headers or {})
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, IOError, OSError):
+                self.pool.discard(key, conn)
+                if attempt:
+                    raise
+
+    def _request(self, url, headers=None, method='GET', allow=()):
+        # Returns the pool key, connection and response. Statuses of 400
+        # and up raise IOError, unless they are in allow. The caller gives
+        # the connection back once the response has been read.
+        for _ in range(self.MAX_REDIRECTS):
+            location = urlparse(url)
+            key = (location.scheme, location.hostname, location.port)
+            path = location.path or '/'
+            if location.query:
+                path += '?' + location.query
+            conn, response = self._send(key, method, path, headers)
+
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                self.pool.release(key, conn)
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status >= 400 and response.status not in allow:
+                response.read()
+                self.pool.release(key, conn)
+                raise IOError('HTTP error %d for %s' % (response.status, url))
+            return key, conn, response
+        raise IOError('Too many redirects for %s' % url)
+
+    def _read(self, url, method='GET'):
+        # Returns the whole response, and gives the connection back
+        key, conn, response = self._request(url, method=method)
+        body = response.read()
+        self.pool.release(key, conn)
+        return response, body
+
+    def list_directory(self, url):
+        # Web server index pages only give approximate sizes, so leave
+        # size and modified empty rather than guess. fetch_shapefiles.py
+        # fills them in from a HEAD request with stat().
+        response, body = self._read(url)
+        body = body.decode('utf-8', 'replace')
+        names = []
+        for href in re.findall(r'href="([^"?#]+)"', body):
+            name = href.rstrip('/').split('/')[-1]
+            if not href.endswith('/') and name not in names:
+                names.append(name)
+        return [{'name': name, 'size': None, 'modified': None}
+                for name in names]
+
+    def stat(self, url):
+        response, _ = self._read(url, method='HEAD')
+        return {
+            'size': int(response.getheader('Content-Length')),
+            'modified': response.getheader('Last-Modified'),
+        }
+
+    def open(self, url, offset=0):
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        key, conn, response = self._request(url, headers, allow=(416,))
+        if response.status == 416:
+            # Nothing left from offset on: the .part file is already
+            # complete, or longer than the remote file if it shrank.
+            # Content-Range: bytes */<total>
+            response.read()
+            self.pool.release(key, conn)
+            content_range = response.getheader('Content-Range') or ''
+            if not content_range.startswith('bytes */'):
+                raise IOError('HTTP error 416 for %s' % url)
+            return io.BytesIO(), int(content_range.split('/')[-1]), offset
+        if offset and response.status == 206:
+            # Content-Range: bytes <start>-<end>/<total>
+            file_size = int(response.getheader('Content-Range').split('/')[-1])
+            return HTTPResponse(self, key, conn, response), file_size, offset
+        file_size = int(response.getheader('Content-Length'))
+        return HTTPResponse(self, key, conn, response), file_size, 0
+
+    def close(self):
+        self.pool.close()
+
+
+class LocalTransport(object):
+    '''
+    Reads from a local mirror of the Census directory tree, given as a
+    file:// URL or a plain directory path.
+    '''
+    def __init__(self, timeout=None, per_host=None):
+        pass
+
+    def _get_path(self, url):
+        if url.startswith('file://'):
+            return url2pathname(urlparse(url).path)
+        return url
+
+    def list_directory(self, url):
+        path = self._get_path(url)
+        entries = []
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            entries.append({
+                'name': name,
+                'size': stat.st_size,
+                'modified': str(int(stat.st_mtime)),
+            })
+        return entries
+
+    def stat(self, url):
+        stat = os.stat(self._get_path(url))
+        return {'size': stat.st_size, 'modified': str(int(stat.st_mtime))}
+
+    def open(self, url, offset=0):
+        path = self._get_path(url)
+        f = open(path, 'rb')
+        f.seek(offset)
+        return f, os.path.getsize(path), offset
+
+    def close(self):
+        pass
+
+
+def get_transport(source, timeout=None, per_host=None):
+    # per_host caps the connections open to any one host at once
+    scheme = urlparse(source).scheme
+    if scheme == 'ftp':
+        return FTPTransport(timeout, per_host)
+    if scheme in ('http', 'https'):
+        return HTTPTransport(timeout, per_host)
+    if scheme in ('file', '') or (sys.platform == 'win32' and len(scheme) == 1):
+        # Windows paths like C:\mirror parse with a one-letter scheme
+        return LocalTransport(timeout, per_host)
+    raise ValueError('Unsupported source: %s' % source)
@@ -27,9 +27,26 @@ to a single geography type.
     >> python parse_shapefiles.py -g place
     >> python parse_shapefiles.py -s WA -g place
 
+With -s, the state filter is applied inside OGR, so features from other
+states are skipped before they reach Python. The first single-state run over
+a national shapefile (counties, congressional districts, states) saves an
+index of which features belong to each state next to it, in a
+`.statefp.json` file, so later runs read only the features they need. Where
+the index can't be saved, as in a read-only `DOWNLOAD_DIR` with -z, OGR's
+attribute filter picks out the state's features instead.
+
+Instead of reading the extracted shapefiles, you can read them straight out
+of the zip files in `DOWNLOAD_DIR`, through GDAL's /vsizip/ virtual
+filesystem, by passing a -z flag. Use this together with
+`fetch_shapefiles.py --no-extract` to skip extraction entirely, so the data
+is only stored on disk once.
+
+    >> python fetch_shapefiles.py --no-extract
+    >> python parse_shapefiles.py -z
+
 This script will generate a single csv file with your chosen data, and write
-it to `CSV_DIR`. Headers are pulled from `helpers/csv_helpers.py`. The methods
-for building rows specific to each geography type are also in `csv_helpers`.
+it to `CSV_DIR`. Headers are pulled from `helpers/csv_helpers.py`. How rows
+are built for each geography type is also defined there, in `ROW_SPECS`.
 
 You can choose whether the generated csv should include polygon geometries,
 which can significantly increase the size of the output file. Include
@@ -39,26 +56,162 @@ geometries by passing a -p flag.
 
 Geometry data for certain geography types can be *very* large. The `zcta5`
 geometries, for instance, will add about 1.1 Gb of data to your csv.
+
+Geometries are written as WKT by default. Pass --geom-format to write them as
+hex-encoded WKB (`wkb-hex`) or GeoJSON (`geojson`) instead, and --precision
+to round coordinates to a number of decimal places. Both can make the csv
+much smaller, and quicker to load elsewhere.
+
+    >> python parse_shapefiles.py -p --geom-format wkb-hex
+    >> python parse_shapefiles.py -p --geom-format geojson --precision 6
+
+To also write simplified versions of each geometry, for instance for maps at
+several zoom levels, pass --simplify with a list of tolerances. Each gets its
+own `GEOMETRY_<tolerance>` column. Simplified geometries are cached in
+`CACHE_DIR`, so they are only worked out again when a shapefile changes,
+and the copies for the old shapefile are removed then.
+
+    >> python parse_shapefiles.py -p --simplify 0.001,0.01,0.1
+
+The output can be written as a Parquet or Arrow IPC file instead of a csv,
+with -f (this needs `pyarrow`). Columns are typed, repetitive text columns
+are dictionary-encoded, and geometries are stored as WKB, so the files are
+much smaller and much quicker to load.
+
+    >> python parse_shapefiles.py -p -f parquet
+
+To load the data into a database, write a GeoPackage (`-f gpkg`) or a
+SpatiaLite database (`-f sqlite`) instead. Rows are inserted in large
+transactions, and the spatial index and indexes on `FULL_GEOID`, `SUMLEV`
+and `STATEFP` are built once everything is loaded, so the file is ready to
+query as soon as the script finishes.
+
+    >> python parse_shapefiles.py -p -f gpkg
+
+Pass -i to also write an index of the csv by `FULL_GEOID`, next to it, in a
+`.idx` file. `helpers/geoid_index_helpers.py` has a GeoidIndex class that
+memory-maps it and binary-searches it, so services can look up single rows
+without loading the csv, however large it is.
+
+    >> python parse_shapefiles.py -p -i
+    >> from helpers.geoid_index_helpers import GeoidIndex
+    >> GeoidIndex('generated_csv/all_geographies.csv').get('05000US53063')
+
+Building the full csv with geometries holds every row in memory while it is
+sorted. Pass --stream to sort on disk instead: rows are written to sorted
+temporary files as each shapefile is read, each holding at most RUN_SIZE
+rows or RUN_BYTES of data, then merged into the csv, so memory use stays
+flat however much data there is. The output is identical.
+
+    >> python parse_shapefiles.py -p --stream
+
+Shapefiles are parsed in parallel, by a pool of worker processes (one per
+CPU by default). Pass -j to change the number of processes; -j 1 parses them
+one at a time. The csv is the same either way. Very large layers, like the
+national `zcta5` shapefile, are split into ranges of features so that every
+process gets a share of them (see CHUNK_FEATURES and CHUNK_SIZE).
+
+    >> python parse_shapefiles.py -p -j 4
+
+The rows built from each shapefile are cached in `CACHE_DIR`, so the next run
+only parses shapefiles that have changed since (by size and modification
+time), or that were parsed with different options, and reuses the rest.
+Rows cached for other states, geography types or options are kept for the
+runs that want them; only those built from shapefiles that have changed or
+gone are removed, once the csv has been written. Pass --no-cache to parse
+everything again without touching the cache.
+
+    >> python parse_shapefiles.py --no-cache
 '''
 
 import csv, optparse, os, sys, traceback
 import glob
-from operator import itemgetter
+import io
+import multiprocessing
+import shutil
+import tempfile
+import time
+import zipfile
+from functools import partial
 from os.path import isdir, join, normpath
 from osgeo import ogr
 
-from __init__ import (EXTRACT_DIR, CSV_DIR, STATE_FIPS_DICT, GEO_TYPES_DICT, \
-    STATE_ABBREV_LIST, GEO_TYPES_LIST, get_fips_code_for_state)
-from helpers import csv_helpers
+from __init__ import (DOWNLOAD_DIR, EXTRACT_DIR, CSV_DIR, CACHE_DIR, \
+    STATE_FIPS_DICT, \
+    GEO_TYPES_DICT, STATE_ABBREV_LIST, GEO_TYPES_LIST, get_fips_code_for_state)
+from helpers import arrow_helpers, csv_helpers, geoid_index_helpers, \
+    gpkg_helpers
+from helpers.cache_helpers import (get_cache_path, get_source_fingerprint,
+    is_source_current, load_cache, prune_cache, save_cache)
+from helpers.file_helpers import split_vsizip_path
+from helpers.pool_helpers import map_ordered
+from helpers.row_store_helpers import RowStore
+from helpers.run_helpers import (get_row_size, merge_runs, read_run,
+    write_run)
+from helpers.state_index_helpers import get_state_ranges
+
+# Output file formats; parquet and arrow need pyarrow, gpkg and sqlite
+# (SpatiaLite) are written through OGR
+OUTPUT_FORMATS = ['csv', 'parquet', 'arrow', 'gpkg', 'sqlite',]
+
+# In --stream mode, rows are sorted and written to disk in runs of at
+# most RUN_SIZE rows or about RUN_BYTES of row data, whichever comes
+# first, then merged into the output csv. Rows with geometry can be
+# hundreds of kilobytes each, so the byte limit is usually what cuts them.
+RUN_SIZE = 50000
+RUN_BYTES = 64 * 1024 * 1024
+
+# Shapefiles are parsed by a pool of PARSE_JOBS worker processes, which
+# each open their own OGR datasources
+PARSE_JOBS = multiprocessing.cpu_count()
+
+# Layers are split into ranges of at most CHUNK_FEATURES features, and
+# about CHUNK_SIZE bytes of .shp file, parsed by separate workers. zcta5,
+# for one, is a single national shapefile. The ranges only depend on the
+# shapefile, not on the number of jobs, so cached rows can be reused
+# whatever -j is.
+CHUNK_FEATURES = 10000
+CHUNK_SIZE = 50 * 1024 * 1024
+
+# Cached run files that no cache entry points to are removed once they are
+# ORPHAN_RUN_AGE seconds old
+ORPHAN_RUN_AGE = 24 * 60 * 60
+
+
+def _get_shapefiles_in_zip(filename):
+    try:
+        zipped = zipfile.ZipFile(filename, 'r')
+    except zipfile.BadZipfile:
+        print("Skipping corrupt zip file: " + filename)
+        return []
+    shapefiles = [
+        name for name in zipped.namelist() if name.lower().endswith('.shp')
+    ]
+    zipped.close()
+    return shapefiles
+
+
+def get_shapefile_zip_list():
+    # GDAL's /vsizip/ virtual filesystem lets OGR treat each zip file
+    # in DOWNLOAD_DIR as a directory of shapefiles
+    return [
+        '/vsizip/%s' % os.path.join(DOWNLOAD_DIR, filename)
+        for filename in os.listdir(DOWNLOAD_DIR)
+        if filename.lower().endswith('.zip') and
+        _get_shapefiles_in_zip(os.path.join(DOWNLOAD_DIR, filename))
+    ]
 
 
-def get_shapefile_directory_list(state=None, geo_type=None):
-    _, directories, _ = next(os.walk(EXTRACT_DIR))
-    shapefile_directory_list = [
-        os.path.join(EXTRACT_DIR, directory)
-        for directory in directories
-        if len(glob.glob(os.path.join(EXTRACT_DIR, directory, '*.shp'))) > 0
-    ]
+def get_shapefile_directory_list(state=None, geo_type=None, from_zip=False):
+    if from_zip:
+        shapefile_directory_list = get_shapefile_zip_list()
+    else:
+        _, directories, _ = next(os.walk(EXTRACT_DIR))
+        shapefile_directory_list = [
+            os.path.join(EXTRACT_DIR, directory)
+            for directory in directories
+            if len(glob.glob(os.path.join(EXTRACT_DIR, directory, '*.shp'))) > 0
+        ]
 
     if geo_type:
         # handle cd112, cd113, zcta5, etc.
@@ -71,7 +224,8 @@ def get_shapefile_directory_list(state=None, geo_type=None):
         else:
             geo_type_check = '_%s' % geo_type.lower()
             shapefile_directory_list = filter(
-                lambda directory: directory.endswith(geo_type_check),
+                lambda directory:
+                    _strip_zip_extension(directory).endswith(geo_type_check),
                 shapefile_directory_list
             )
 
@@ -87,7 +241,30 @@ def get_shapefile_directory_list(state=None, geo_type=None):
     return shapefile_directory_list
 
 
+def iter_shapefiles(state=None, geo_types=None, from_zip=False):
+    # Yields (shapefile, geo_type) for each shapefile found, optionally
+    # only for some geo types
+    for shapefile_directory in get_shapefile_directory_list(
+            state=state, from_zip=from_zip):
+        _shapefile = _get_shapefile_from_dir(shapefile_directory)
+        _geo_type = _get_geo_type_from_file(_shapefile)
+        if not geo_types or _geo_type in geo_types:
+            yield _shapefile, _geo_type
+
+
+def _strip_zip_extension(directory):
+    if directory.lower().endswith('.zip'):
+        return directory[:-len('.zip')]
+    return directory
+
+
 def _get_shapefile_from_dir(shapefile_directory):
+    if shapefile_directory.startswith('/vsizip/'):
+        zip_filename = shapefile_directory[len('/vsizip/'):]
+        for filename in _get_shapefiles_in_zip(zip_filename):
+            return '%s/%s' % (shapefile_directory, filename)
+        raise Exception('No .shp file found in %s' % zip_filename)
+
     for filename in os.listdir(shapefile_directory):
         if filename.lower().endswith('.shp'):
             return normpath(join(shapefile_directory, filename))
@@ -95,7 +272,7 @@ def _get_shapefile_from_dir(shapefile_directory):
 
 
 def _get_geo_type_from_file(filename):
-    basename = filename.split('.')[0]
+    basename = os.path.basename(filename).split('.')[0]
     geo_type = basename.split('_')[-1]
     # handle cd112, cd113, etc.
     if geo_type.startswith('cd'):
@@ -106,87 +283,522 @@ def _get_geo_type_from_file(filename):
     return geo_type
 
 
-def parse_shapefiles(shapefile_directory_list, state=None, geo_type=None,
-                     include_polygon=False):
-    data_dicts = []
+def _get_shapefile_size(filename):
+    zip_filename, member = split_vsizip_path(filename)
+    if zip_filename:
+        zipped = zipfile.ZipFile(zip_filename, 'r')
+        try:
+            return zipped.getinfo(member).file_size
+        finally:
+            zipped.close()
+    return os.path.getsize(filename)
+
+
+def _get_feature_count(filename):
+    shapefile = ogr.Open(filename)
+    feature_count = shapefile.GetLayer().GetFeatureCount()
+    shapefile.Destroy()
+    return feature_count
+
+
+def get_parse_tasks(shapefile_directory_list, state=None):
+    # Returns a (shapefile, start, stop) task for each shapefile, with stop
+    # None for the end of the layer. Large layers are split into ranges of
+    # features instead, in feature order. With a state, layers are
+    # filtered inside OGR and not split.
+    tasks = []
     for shapefile_directory in shapefile_directory_list:
         _shapefile = _get_shapefile_from_dir(shapefile_directory)
-        _geo_type = _get_geo_type_from_file(_shapefile)
-
-        print("Parsing: " + _shapefile + " ...")
-        _shapefile_data = build_dict_list(
+        chunks = 1
+        if not state:
+            feature_count = _get_feature_count(_shapefile)
+            chunks = min(feature_count, max(
+                -(-feature_count // CHUNK_FEATURES),
+                -(-_get_shapefile_size(_shapefile) // CHUNK_SIZE)))
+
+        if chunks > 1:
+            # The feature count leaves out deleted records, so the last
+            # range reads to the end of the layer to cover every FID
+            bounds = [feature_count * i // chunks for i in range(chunks)]
+            for start, stop in zip(bounds, bounds[1:] + [None]):
+                tasks.append((_shapefile, start, stop))
+        else:
+            tasks.append((_shapefile, 0, None))
+    return tasks
+
+
+def _print_parsing(shapefile, start, stop):
+    if not start and stop is None:
+        print("Parsing: " + shapefile + " ...")
+    elif stop is None:
+        print("Parsing: %s (features %d-end) ..." % (shapefile, start))
+    else:
+        print("Parsing: %s (features %d-%d) ..." % (shapefile, start, stop - 1))
+
+
+def _parse_shapefile(task, state=None, include_polygon=False,
+                     geometry_options=None, use_cache=True):
+    _shapefile, start, stop = task
+    _geo_type = _get_geo_type_from_file(_shapefile)
+
+    _print_parsing(_shapefile, start, stop)
+    return build_row_list(
+        _shapefile, state=state, geo_type=_geo_type,
+        include_polygon=include_polygon, geometry_options=geometry_options,
+        start=start, stop=stop, use_cache=use_cache)
+
+
+def _parse_shapefile_to_runs(task, run_dir, state=None,
+                             include_polygon=False, geometry_options=None,
+                             run_size=RUN_SIZE, run_bytes=RUN_BYTES,
+                             use_cache=True):
+    # Write a task's rows to sorted run files of at most run_size rows
+    # or about run_bytes of row data, and return their paths
+    _shapefile, start, stop = task
+    _geo_type = _get_geo_type_from_file(_shapefile)
+
+    _print_parsing(_shapefile, start, stop)
+    run_list = []
+    rows = []
+    rows_bytes = 0
+    for row in iter_rows(
             _shapefile, state=state, geo_type=_geo_type,
-            include_polygon=include_polygon)
-        data_dicts.extend(_shapefile_data)
+            include_polygon=include_polygon,
+            geometry_options=geometry_options, start=start, stop=stop,
+            use_cache=use_cache):
+        rows.append(row)
+        rows_bytes += get_row_size(row)
+        if len(rows) >= run_size or rows_bytes >= run_bytes:
+            run_list.append(write_run(run_dir, rows))
+            rows = []
+            rows_bytes = 0
+    if rows:
+        run_list.append(write_run(run_dir, rows))
+    return run_list
+
+
+def _get_parse_cache_keys(task, state=None, include_polygon=False,
+                          geometry_options=None):
+    # Returns the key naming a task's cache entry, and the key the entry
+    # must have been built with to be used: the same settings plus a
+    # fingerprint of the source files and the row builder version
+    _shapefile, start, stop = task
+    name_key = {
+        'shapefile': _shapefile,
+        'start': start,
+        'stop': stop,
+        'state': state,
+        'include_polygon': bool(include_polygon),
+        'geometry_options': geometry_options or {},
+    }
+    content_key = dict(name_key)
+    content_key.update({
+        'source': get_source_fingerprint(_shapefile),
+        'geo_type': _get_geo_type_from_file(_shapefile),
+        'version': csv_helpers.ROW_BUILDER_VERSION,
+    })
+    return name_key, content_key
+
+
+def _parse_shapefile_cached(task, state=None, include_polygon=False,
+                            geometry_options=None, run_size=RUN_SIZE,
+                            run_bytes=RUN_BYTES):
+    # Like _parse_shapefile_to_runs, but the runs are kept in CACHE_DIR and
+    # reused for as long as the shapefile and settings stay the same
+    _shapefile, start, stop = task
+    name_key, content_key = _get_parse_cache_keys(
+        task, state=state, include_polygon=include_polygon,
+        geometry_options=geometry_options)
+    entry_path = get_cache_path(CACHE_DIR, 'parse', name_key)
+
+    entry = load_cache(entry_path)
+    if entry is not None:
+        run_list = [join(CACHE_DIR, name) for name in entry['runs']]
+        if entry['key'] == content_key and all(
+                os.path.exists(path) for path in run_list):
+            print("Cached: " + _shapefile)
+            return run_list
+        # Out of date, so replace it
+        for path in run_list:
+            _remove_cache_file(path)
+
+    run_list = _parse_shapefile_to_runs(
+        task, CACHE_DIR, state=state, include_polygon=include_polygon,
+        geometry_options=geometry_options, run_size=run_size,
+        run_bytes=run_bytes)
+    save_cache(entry_path, {
+        'key': content_key,
+        'runs': [os.path.basename(path) for path in run_list],
+    })
+    return run_list
+
+
+def _is_parse_entry_current(entry):
+    key = entry['key']
+    return (key.get('version') == csv_helpers.ROW_BUILDER_VERSION and
+            is_source_current(key['shapefile'], key['source']))
+
+
+def _is_simplify_entry_current(entry):
+    return (isinstance(entry, dict) and
+            is_source_current(entry['shapefile'], entry['source']))
+
+
+def _prune_cache():
+    # Remove the cached rows and simplified geometry built from shapefiles
+    # that have since changed or gone, and rows built by an older row
+    # builder. Entries for other shapefiles and options are kept, so a run
+    # for one state, geography type or set of options doesn't throw away
+    # what a full run cached.
+    kept, removed = prune_cache(CACHE_DIR, 'parse', _is_parse_entry_current)
+    for entry in removed:
+        for name in entry['runs']:
+            _remove_cache_file(join(CACHE_DIR, name))
+    prune_cache(CACHE_DIR, 'simplify', _is_simplify_entry_current)
+
+    # Run files no entry points to are left by interrupted runs. Only old
+    # ones are removed: a run going on now may not have saved the entry
+    # for the runs it just wrote.
+    used = set(name for entry in kept for name in entry['runs'])
+    now = time.time()
+    for path in glob.glob(join(CACHE_DIR, '*.run')):
+        if os.path.basename(path) in used:
+            continue
+        try:
+            if now - os.path.getmtime(path) > ORPHAN_RUN_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _remove_cache_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # Already removed by another run
+        pass
+
 
+def parse_shapefiles(shapefile_directory_list, state=None, geo_type=None,
+                     include_polygon=False, geometry_options=None,
+                     stream=False, jobs=PARSE_JOBS, output_format='csv',
+                     use_cache=True, index=False):
     output_geo = geo_type if geo_type else 'all_geographies'
     output_state = '_%s' % state if state else ''
-    output_filename = '%s%s.csv' % (output_geo, output_state)
-    sorted_data_dicts = sorted(data_dicts, key=itemgetter('FULL_GEOID'))
-
-    write_csv(output_filename, sorted_data_dicts,
-              include_polygon=include_polygon)
-
-
-def build_dict_list(filename, state=None, geo_type=None,
-                    include_polygon=False):
+    output_filename = '%s%s.%s' % (output_geo, output_state, output_format)
+
+    if stream:
+        parse_shapefiles_to_runs(
+            shapefile_directory_list, output_filename, state=state,
+            include_polygon=include_polygon,
+            geometry_options=geometry_options, jobs=jobs,
+            output_format=output_format, use_cache=use_cache,
+            index=index)
+        return
+
+    # Rows are kept column by column in a RowStore, which takes a fraction
+    # of the memory of one tuple per row. Results come back in task order,
+    # and the sort is stable, so the output doesn't depend on the number
+    # of jobs.
+    row_store = RowStore(csv_helpers.get_fields_for_csv(
+        include_polygon=include_polygon,
+        simplify=(geometry_options or {}).get('simplify')))
+    tasks = get_parse_tasks(shapefile_directory_list, state=state)
+    run_list = []
+    if use_cache:
+        # Each task's rows come back as cached runs, which are read into
+        # the store in order
+        parse = partial(
+            _parse_shapefile_cached, state=state,
+            include_polygon=include_polygon,
+            geometry_options=geometry_options)
+        for _shapefile_runs in map_ordered(parse, tasks, jobs):
+            for run in _shapefile_runs:
+                row_store.extend(read_run(run))
+            run_list.extend(_shapefile_runs)
+    else:
+        parse = partial(
+            _parse_shapefile, state=state, include_polygon=include_polygon,
+            geometry_options=geometry_options, use_cache=False)
+        for _shapefile_rows in map_ordered(parse, tasks, jobs):
+            row_store.extend(_shapefile_rows)
+
+    # FULL_GEOID is the first field
+    write_output(output_filename, row_store.iter_sorted(0),
+                 include_polygon=include_polygon,
+                 geometry_options=geometry_options,
+                 output_format=output_format, index=index)
+    if use_cache:
+        _prune_cache()
+
+
+def parse_shapefiles_to_runs(shapefile_directory_list, output_filename,
+                             state=None, include_polygon=False,
+                             geometry_options=None, run_size=RUN_SIZE,
+                             run_bytes=RUN_BYTES, jobs=PARSE_JOBS,
+                             output_format='csv', use_cache=True,
+                             index=False):
+    # Write each shapefile's rows to sorted run files, then merge the runs
+    # straight into the output file, so memory use doesn't grow with the
+    # size of the dataset
+    run_dir = tempfile.mkdtemp(prefix='runs_', dir=CSV_DIR)
+    try:
+        run_list = []
+        if use_cache:
+            parse = partial(
+                _parse_shapefile_cached, state=state,
+                include_polygon=include_polygon,
+                geometry_options=geometry_options, run_size=run_size,
+                run_bytes=run_bytes)
+        else:
+            parse = partial(
+                _parse_shapefile_to_runs, run_dir=run_dir, state=state,
+                include_polygon=include_polygon,
+                geometry_options=geometry_options, run_size=run_size,
+                run_bytes=run_bytes, use_cache=False)
+        tasks = get_parse_tasks(shapefile_directory_list, state=state)
+        for _shapefile_runs in map_ordered(parse, tasks, jobs):
+            run_list.extend(_shapefile_runs)
+
+        # Cached runs are merged but never removed
+        keep = set(run_list) if use_cache else ()
+        write_output(output_filename, merge_runs(run_list, run_dir, keep=keep),
+                     include_polygon=include_polygon,
+                     geometry_options=geometry_options,
+                     output_format=output_format, index=index)
+        if use_cache:
+            _prune_cache()
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def build_row_list(filename, state=None, geo_type=None,
+                   include_polygon=False, geometry_options=None,
+                   start=0, stop=None, use_cache=True):
+    return list(iter_rows(
+        filename, state=state, geo_type=geo_type,
+        include_polygon=include_polygon, geometry_options=geometry_options,
+        start=start, stop=stop, use_cache=use_cache))
+
+
+def _iter_features(layer, ranges):
+    # Yields the layer's features within each [start, stop) range of
+    # feature IDs; stop=None reads to the end. Shapefile FIDs are record
+    # numbers, which skip deleted records, so the range ends at the first
+    # FID past it rather than after stop - start features.
+    for start, stop in ranges:
+        if start:
+            layer.SetNextByIndex(start)
+        feature = layer.GetNextFeature()
+        while feature and (stop is None or feature.GetFID() < stop):
+            yield feature
+            feature.Destroy()
+            feature = layer.GetNextFeature()
+
+
+def _set_ignored_fields(layer, geo_type, include_polygon=False):
+    # Only decode the attributes the row builders read, and the geometry
+    # only when it goes in the csv
+    ignored_fields = [] if include_polygon else ['OGR_GEOMETRY']
+    needed_fields = csv_helpers.get_attributes_for_geo_type(geo_type)
+    if needed_fields is not None:
+        layer_defn = layer.GetLayerDefn()
+        for i in range(layer_defn.GetFieldCount()):
+            name = layer_defn.GetFieldDefn(i).GetName()
+            if name not in needed_fields:
+                ignored_fields.append(name)
+    layer.SetIgnoredFields(ignored_fields)
+
+
+def _get_simplify_cache_path(source, tolerance, geometry_options,
+                             state=None, start=0, stop=None):
+    # Simplified geometries are cached for each tolerance, and for the
+    # exact set of features (state, range) they were built from. source is
+    # the shapefile's fingerprint. Entries are {'shapefile', 'source',
+    # 'values'}, so prune_cache can tell when the shapefile has changed.
+    key = {
+        'source': source,
+        'tolerance': tolerance,
+        'format': geometry_options.get('format', 'wkt'),
+        'precision': geometry_options.get('precision'),
+        'state': state,
+        'start': start,
+        'stop': stop,
+    }
+    return get_cache_path(CACHE_DIR, 'simplify', key)
+
+
+def _open_layer(filename, state=None, geo_type=None, include_polygon=False,
+                start=0, stop=None):
+    # Returns the datasource, its layer, and the ranges of features to
+    # read, with features from states other than state filtered out
+    # where we can
     shapefile = ogr.Open(filename)
     layer = shapefile.GetLayer()
     state_check = get_fips_code_for_state(state) if state else None
-    dict_list = []
-
-    feature = layer.GetNextFeature()
-    while feature:
-        item = {}
-        if geo_type == 'zcta5':
-            # ZCTA shapefiles have different attribute names
-            _item_options = {
-                'include_polygon': include_polygon,
-            }
-            item = csv_helpers.make_zcta5_row(
-                feature, item, geo_type, _item_options)
+    ranges = [(start, stop)]
+
+    # Per-state files only hold the one state, so only national files
+    # need filtering. They keep a sidecar index of each state's features;
+    # without one, OGR skips the other states' features itself, using a
+    # .dbf attribute index if there is one.
+    if (state_check and geo_type != 'zcta5' and
+            '_us_' in os.path.basename(filename)):
+        state_ranges = get_state_ranges(filename, layer, state_check)
+        if state_ranges is None:
+            layer.SetAttributeFilter("STATEFP = '%s'" % state_check)
         else:
-            # All other geo_types share attribute names
-            # Filter rows by state if -s arg is passed
-            _statefp = feature.GetField("STATEFP")
-            if not state_check or (state_check == _statefp):
-                _item_options = {
-                    'statefp': _statefp,
-                    'include_polygon': include_polygon,
-                    'geoid': feature.GetField("GEOID"),
-                    'state_dict': STATE_FIPS_DICT[str(_statefp)],
-                }
-
-                item = csv_helpers.make_basic_row(feature, item, geo_type, _item_options)
-                if geo_type:
-                    row_builder = getattr(csv_helpers, 'make_%s_row' % geo_type)
-                    item = row_builder(feature, item, _item_options)
-
-        if item:
-            dict_list.append(item)
-        feature.Destroy()
-        feature = layer.GetNextFeature()
-
-    shapefile.Destroy()
-
-    return dict_list
+            ranges = state_ranges
+    _set_ignored_fields(layer, geo_type, include_polygon=include_polygon)
+    return shapefile, layer, ranges
+
+
+def iter_rows(filename, state=None, geo_type=None,
+              include_polygon=False, geometry_options=None,
+              start=0, stop=None, use_cache=True):
+    # Yields csv rows, as tuples in get_fields_for_csv order. Only reads
+    # features start to stop - 1 of the layer; stop=None reads to the end.
+    # geometry_options are passed on to csv_helpers.RowBuilder. With
+    # use_cache False, simplified geometry is neither read from nor saved
+    # to CACHE_DIR.
+    shapefile, layer, ranges = _open_layer(
+        filename, state=state, geo_type=geo_type,
+        include_polygon=include_polygon, start=start, stop=stop)
+    state_check = get_fips_code_for_state(state) if state else None
 
+    try:
+        row_builder = csv_helpers.RowBuilder(
+            layer.GetLayerDefn(), geo_type, include_polygon=include_polygon,
+            geometry_options=geometry_options,
+            state_fips_dict=STATE_FIPS_DICT)
+        if row_builder.statefp_index is None:
+            # ZCTAs aren't filtered by state
+            state_check = None
+
+        # Reuse cached simplified geometry where we have it, and collect
+        # the rest to cache once the whole layer has been read
+        new_simplified = []
+        if use_cache and row_builder.simplify:
+            source = get_source_fingerprint(filename)
+        for _, tolerance, _ in (row_builder.simplify if use_cache else ()):
+            cache_path = _get_simplify_cache_path(
+                source, tolerance, geometry_options, state=state,
+                start=start, stop=stop)
+            cached = load_cache(cache_path)
+            # Entries saved before they recorded their shapefile are plain
+            # lists; build those again
+            if isinstance(cached, dict):
+                row_builder.use_cached_geometry(tolerance, cached['values'])
+            else:
+                new_simplified.append((
+                    row_builder.get_simplified_position(tolerance),
+                    cache_path, []))
+
+        for feature in _iter_features(layer, ranges):
+            if state_check and row_builder.get_statefp(feature) != state_check:
+                continue
+            row = row_builder.build(feature)
+            for position, _, values in new_simplified:
+                values.append(row[position])
+            yield row
+
+        for _, cache_path, values in new_simplified:
+            save_cache(cache_path, {
+                'shapefile': filename,
+                'source': source,
+                'values': values,
+            })
+    finally:
+        shapefile.Destroy()
+
+
+def iter_polygons(filename, state=None, geo_type=None):
+    # Yields (FULL_GEOID, geometry) for each feature with a geometry, for
+    # spatial lookups. Geometries are cloned, so they outlive the layer.
+    shapefile, layer, ranges = _open_layer(
+        filename, state=state, geo_type=geo_type, include_polygon=True)
+    state_check = get_fips_code_for_state(state) if state else None
 
-def write_csv(filename, dict_list, include_polygon=False):
+    try:
+        row_builder = csv_helpers.RowBuilder(
+            layer.GetLayerDefn(), geo_type, state_fips_dict=STATE_FIPS_DICT)
+        if row_builder.statefp_index is None:
+            state_check = None
+
+        for feature in _iter_features(layer, ranges):
+            if state_check and row_builder.get_statefp(feature) != state_check:
+                continue
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            row = row_builder.build(feature)
+            yield row[row_builder.full_geoid_position], geometry.Clone()
+    finally:
+        shapefile.Destroy()
+
+
+def _get_csv_path(filename):
     csvfilename = os.path.basename(filename).replace('.shp', '.csv')
-    csvpath = normpath(join(CSV_DIR, csvfilename))
-    csvfile = open(csvpath, 'w')
+    return normpath(join(CSV_DIR, csvfilename))
+
+
+def write_output(filename, rows, include_polygon=False,
+                 geometry_options=None, output_format='csv', index=False):
+    if output_format == 'csv':
+        write_csv(filename, rows, include_polygon=include_polygon,
+                  geometry_options=geometry_options, index=index)
+        return
+
+    geometry_options = geometry_options or {}
+    path = normpath(join(CSV_DIR, os.path.basename(filename)))
+    fields = csv_helpers.get_fields_for_csv(
+        include_polygon=include_polygon,
+        simplify=geometry_options.get('simplify'))
+    print("Writing: " + path + " ...\n")
+    if output_format in gpkg_helpers.DATABASE_FORMATS:
+        gpkg_helpers.write_database(
+            path, rows, fields, output_format=output_format)
+    else:
+        arrow_helpers.write_arrow(
+            path, rows, fields, output_format=output_format,
+            binary_geometry=geometry_options.get('format') == 'wkb')
+
+
+def write_csv(filename, rows, include_polygon=False, geometry_options=None,
+              index=False):
+    # rows are sequences of values in get_fields_for_csv order
+    csvpath = _get_csv_path(filename)
+    if bytes is str:
+        # Python 2's csv module writes bytes
+        csvfile = open(csvpath, 'wb')
+    else:
+        # Always UTF-8, and no newline translation, so the bytes on disk
+        # are the ones the FULL_GEOID index counted
+        csvfile = io.open(csvpath, 'w', encoding='utf-8', newline='')
+    fields = csv_helpers.get_fields_for_csv(
+        include_polygon=include_polygon,
+        simplify=(geometry_options or {}).get('simplify'))
 
     print("Writing: " + csvpath + " ...\n")
-    csvwriter = csv.DictWriter(
-        csvfile,
-        csv_helpers.get_fields_for_csv(include_polygon=include_polygon),
-        quoting=csv.QUOTE_ALL
-    )
-    csvwriter.writeheader()
-    for item in dict_list:
-        csvwriter.writerow(item)
+    if not index:
+        csvwriter = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
+        csvwriter.writerow(fields)
+        csvwriter.writerows(rows)
+        csvfile.close()
+        return
+
+    # Count bytes as rows are written, to know where each one starts
+    tracker = geoid_index_helpers.OffsetTracker(csvfile)
+    csvwriter = csv.writer(tracker, quoting=csv.QUOTE_ALL)
+    csvwriter.writerow(fields)
+    geoid_position = fields.index('FULL_GEOID')
+    entries = []
+    for row in rows:
+        entries.append((row[geoid_position], tracker.offset))
+        csvwriter.writerow(row)
     csvfile.close()
+    geoid_index_helpers.write_index(
+        geoid_index_helpers.get_index_path(csvpath), entries)
 
 
 def process_options(arglist=None):
@@ -212,7 +824,92 @@ def process_options(arglist=None):
         dest='include_polygon',
         help='include polygon geometry in output csv'
     )
+    parser.add_option(
+        '-f', '--format',
+        dest='output_format',
+        default='csv',
+        help='output file format: %s' % ', '.join(OUTPUT_FORMATS),
+        choices=OUTPUT_FORMATS
+    )
+    parser.add_option(
+        '-i', '--index',
+        action='store_true',
+        dest='index',
+        help='also write a FULL_GEOID index of the csv, for fast lookups'
+    )
+    parser.add_option(
+        '--geom-format',
+        dest='geom_format',
+        default=None,
+        help='how polygon geometry is written: %s (default wkt for csv, '
+             'wkb otherwise)' % ', '.join(csv_helpers.GEOMETRY_FORMATS),
+        choices=csv_helpers.GEOMETRY_FORMATS
+    )
+    parser.add_option(
+        '--simplify',
+        dest='simplify',
+        default=None,
+        help='comma-separated tolerances to also write simplified polygon '
+             'geometry at, e.g. 0.001,0.01,0.1'
+    )
+    parser.add_option(
+        '--precision',
+        dest='precision',
+        type='int',
+        default=None,
+        help='round polygon coordinates to this many decimal places'
+    )
+    parser.add_option(
+        '-z', '--zipped',
+        action='store_true',
+        dest='from_zip',
+        help='read shapefiles directly from the zip files in DOWNLOAD_DIR'
+    )
+    parser.add_option(
+        '--stream',
+        action='store_true',
+        dest='stream',
+        help='sort on disk instead of in memory, for very large outputs'
+    )
+    parser.add_option(
+        '--no-cache',
+        action='store_false',
+        dest='use_cache',
+        default=True,
+        help='parse every shapefile again instead of reusing cached rows'
+    )
+    parser.add_option(
+        '-j', '--jobs',
+        dest='jobs',
+        type='int',
+        help='number of processes parsing shapefiles',
+        default=PARSE_JOBS
+    )
     options, args = parser.parse_args(arglist)
+    if options.simplify:
+        if not options.include_polygon:
+            parser.error('--simplify needs -p')
+        try:
+            options.simplify = [
+                float(tolerance) for tolerance in options.simplify.split(',')
+            ]
+        except ValueError:
+            parser.error('--simplify takes comma-separated numbers')
+    if options.output_format in gpkg_helpers.DATABASE_FORMATS:
+        if options.geom_format not in (None, 'wkb'):
+            parser.error('--format %s stores geometry natively; leave out '
+                         '--geom-format' % options.output_format)
+    if options.geom_format is None:
+        options.geom_format = 'wkt' if options.output_format == 'csv' \
+            else 'wkb'
+    if options.geom_format == 'wkb' and options.output_format == 'csv':
+        parser.error('--geom-format wkb is binary and can\'t be written '
+                     'to a csv; use wkb-hex instead')
+    if options.index and options.output_format != 'csv':
+        parser.error('-i indexes csv output only')
+    if options.output_format in ('parquet', 'arrow') and \
+            arrow_helpers.pyarrow is None:
+        parser.error('--format %s needs pyarrow' % options.output_format)
     return options, args
 
 
@@ -229,20 +926,31 @@ def main(args=None):
     options, args = process_options(args)
 
     # make sure we have the expected directories
-    for path in (CSV_DIR, ):
+    for path in (CSV_DIR, CACHE_DIR, ):
         if not isdir(path):
             os.makedirs(path)
 
     shapefile_directory_list = get_shapefile_directory_list(
         state=options.state,
         geo_type=options.geo_type,
+        from_zip=options.from_zip,
     )
 
     parse_shapefiles(
         shapefile_directory_list,
         state=options.state,
         geo_type=options.geo_type,
-        include_polygon=options.include_polygon
+        include_polygon=options.include_polygon,
+        geometry_options={
+            'format': options.geom_format,
+            'precision': options.precision,
+            'simplify': options.simplify,
+        },
+        stream=options.stream,
+        jobs=options.jobs,
+        output_format=options.output_format,
+        use_cache=options.use_cache,
+        index=options.index
     )
 
 
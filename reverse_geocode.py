@@ -0,0 +1,263 @@
+'''
+After you run `fetch_shapefiles.py`, this script will find the geographies
+each of a file of points falls in: the places, counties, congressional and
+state legislative districts, school districts and so on.
+
+Points are read from a csv with a header row, with longitude and latitude in
+`lon` and `lat` columns (pass --lon-field and --lat-field for other names).
+The output csv has the same columns, plus a `<GEO_TYPE>_FULL_GEOID` column
+for each geography type, holding the `FULL_GEOID` of every geography that
+contains the point, separated by semicolons. It is written to `CSV_DIR`
+unless you pass -o.
+
+    >> python reverse_geocode.py addresses.csv
+    >> python reverse_geocode.py addresses.csv -o addresses_geocoded.csv
+
+Pass an -s argument to only load geographies for one state, and/or a -g
+argument with one or more comma-separated geography types. Fewer polygons
+means quicker startup and less memory. Pass -z to read the shapefiles
+straight out of the zip files in `DOWNLOAD_DIR`, as with
+`parse_shapefiles.py`.
+
+    >> python reverse_geocode.py addresses.csv -s WA -g place,county,cd
+
+Needs shapely 2 (`pip install shapely`). Polygons are loaded once, into
+an index for each geography type (see `helpers/spatial_helpers.py`): an
+STRtree of their bounding boxes narrows each point down to a few candidate
+polygons, which are prepared so GEOS can test them exactly and quickly.
+Points are read in batches of BATCH_SIZE, and each batch is looked up in
+one call per geography type. Batches are shared out between a pool of
+worker processes, one per CPU by default; pass -j to change how many. The
+workers are forked once the polygons are loaded, so they share them rather
+than each loading their own. Rows are written in input order.
+
+    >> python reverse_geocode.py addresses.csv -j 8 --batch-size 50000
+'''
+
+import csv, optparse, os, sys, time
+import io
+import multiprocessing
+from functools import partial
+from os.path import isdir, join, normpath
+
+try:
+    import numpy
+    import shapely
+except ImportError:
+    numpy = shapely = None
+
+from __init__ import CSV_DIR, STATE_ABBREV_LIST, GEO_TYPES_LIST
+from helpers import spatial_helpers
+from helpers.pool_helpers import map_ordered
+from helpers.spatial_helpers import (get_indexes, init_worker,
+    load_polygon_indexes, set_indexes)
+
+# Points are geocoded in batches of BATCH_SIZE, by a pool of
+# GEOCODE_JOBS worker processes
+BATCH_SIZE = 10000
+GEOCODE_JOBS = multiprocessing.cpu_count()
+
+# Most batches handed to the pool at once, per worker, so a large input
+# file isn't read into memory faster than it is geocoded
+BATCHES_PER_JOB = 4
+
+
+def geocode_batch(batch, lon_position, lat_position):
+    # Returns each row of batch with the FULL_GEOIDs containing its point
+    # added, one column per geo_type. Rows without a usable point get
+    # empty columns.
+    xs = numpy.full(len(batch), numpy.nan)
+    ys = numpy.full(len(batch), numpy.nan)
+    for i, row in enumerate(batch):
+        try:
+            xs[i] = float(row[lon_position])
+            ys[i] = float(row[lat_position])
+        except (ValueError, IndexError):
+            pass
+    usable = numpy.flatnonzero(numpy.isfinite(xs) & numpy.isfinite(ys))
+    points = shapely.points(xs[usable], ys[usable])
+    usable = usable.tolist()
+
+    columns = []
+    for _, index in get_indexes():
+        column = [''] * len(batch)
+        for position, ids in index.lookup_points(points).items():
+            column[usable[position]] = ';'.join(ids)
+        columns.append(column)
+    return [
+        row + [column[i] for column in columns]
+        for i, row in enumerate(batch)
+    ]
+
+
+def _iter_batches(reader, batch_size):
+    batch = []
+    for row in reader:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _get_output_path(filename):
+    name, extension = os.path.splitext(os.path.basename(filename))
+    return normpath(join(CSV_DIR, '%s_geocoded%s' % (name, extension or '.csv')))
+
+
+def reverse_geocode(input_filename, output_filename, lon_field='lon',
+                    lat_field='lat', state=None, geo_types=None,
+                    from_zip=False, jobs=GEOCODE_JOBS, batch_size=BATCH_SIZE):
+    indexes = load_polygon_indexes(
+        state=state, geo_types=geo_types, from_zip=from_zip)
+    if not indexes:
+        print("No shapefiles found to geocode against")
+        return
+    set_indexes(indexes)
+    print("Loaded %d polygons\n" % sum(len(index) for _, index in indexes))
+
+    if bytes is str:
+        # Python 2's csv module reads and writes bytes
+        infile = open(input_filename, 'rb')
+        outfile = open(output_filename, 'wb')
+    else:
+        # The csv module does its own newline handling
+        infile = io.open(input_filename, 'r', encoding='utf-8', newline='')
+        outfile = io.open(output_filename, 'w', encoding='utf-8', newline='')
+    try:
+        reader = csv.reader(infile)
+        header = next(reader)
+        for field in (lon_field, lat_field):
+            if field not in header:
+                raise Exception('No %s column in %s' % (field, input_filename))
+
+        writer = csv.writer(outfile, quoting=csv.QUOTE_ALL)
+        writer.writerow(header + [
+            '%s_FULL_GEOID' % _geo_type.upper() for _geo_type, _ in indexes
+        ])
+
+        print("Writing: " + output_filename + " ...")
+        started = time.time()
+        point_count = 0
+        geocode = partial(
+            geocode_batch, lon_position=header.index(lon_field),
+            lat_position=header.index(lat_field))
+        for rows in map_ordered(
+                geocode, _iter_batches(reader, batch_size), jobs,
+                initializer=init_worker,
+                initargs=(state, geo_types, from_zip),
+                max_pending=jobs * BATCHES_PER_JOB):
+            writer.writerows(rows)
+            point_count += len(rows)
+        elapsed = time.time() - started
+    finally:
+        infile.close()
+        outfile.close()
+
+    print("Geocoded %d points in %.1fs (%d points/s)\n" % (
+        point_count, elapsed, point_count / max(elapsed, 0.001)))
+
+
+def process_options(arglist=None):
+    global options, args
+    parser = optparse.OptionParser(usage='%prog [options] POINTS_CSV')
+    parser.add_option(
+        '-o', '--output',
+        dest='output',
+        default=None,
+        help='csv file to write (default: CSV_DIR/<input>_geocoded.csv)'
+    )
+    parser.add_option(
+        '--lon-field',
+        dest='lon_field',
+        default='lon',
+        help='name of the longitude column'
+    )
+    parser.add_option(
+        '--lat-field',
+        dest='lat_field',
+        default='lat',
+        help='name of the latitude column'
+    )
+    parser.add_option(
+        '-s', '--state',
+        dest='state',
+        default=None,
+        help='only load geographies for this state',
+        choices=STATE_ABBREV_LIST,
+    )
+    parser.add_option(
+        '-g', '--geo', '--geo_type',
+        dest='geo_types',
+        default=None,
+        help='geographic type or comma-separated types to load'
+    )
+    parser.add_option(
+        '-z', '--zipped',
+        action='store_true',
+        dest='from_zip',
+        help='read shapefiles directly from the zip files in DOWNLOAD_DIR'
+    )
+    parser.add_option(
+        '-j', '--jobs',
+        dest='jobs',
+        type='int',
+        help='number of processes geocoding points',
+        default=GEOCODE_JOBS
+    )
+    parser.add_option(
+        '--batch-size',
+        dest='batch_size',
+        type='int',
+        help='number of points handed to a process at a time',
+        default=BATCH_SIZE
+    )
+    options, args = parser.parse_args(arglist)
+    if len(args) != 1:
+        parser.error('pass one csv file of points')
+    if options.geo_types:
+        options.geo_types = [
+            geo_type.strip() for geo_type in options.geo_types.split(',')
+        ]
+        for geo_type in options.geo_types:
+            if geo_type not in GEO_TYPES_LIST:
+                parser.error('invalid geo type: %r (choose from %s)' % (
+                    geo_type, ', '.join(GEO_TYPES_LIST)))
+    if options.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    if spatial_helpers.shapely is None:
+        parser.error('reverse_geocode.py needs shapely 2')
+    return options, args
+
+
+def main(args=None):
+    """
+    >> python reverse_geocode.py addresses.csv
+    >> python reverse_geocode.py addresses.csv -s WA
+    >> python reverse_geocode.py addresses.csv -g place,county
+    >> python reverse_geocode.py addresses.csv -o geocoded.csv -j 8
+    """
+    if args is None:
+        args = sys.argv[1:]
+    options, args = process_options(args)
+
+    # make sure we have the expected directories
+    if not options.output and not isdir(CSV_DIR):
+        os.makedirs(CSV_DIR)
+
+    reverse_geocode(
+        args[0],
+        options.output or _get_output_path(args[0]),
+        lon_field=options.lon_field,
+        lat_field=options.lat_field,
+        state=options.state,
+        geo_types=options.geo_types,
+        from_zip=options.from_zip,
+        jobs=options.jobs,
+        batch_size=options.batch_size,
+    )
+
+
+if __name__ == '__main__':
+    main()